@@ -0,0 +1,405 @@
+"""Load test for the slurm-provisioner server extension.
+
+Starts a Jupyter server with the extension in a temporary $HOME, a stub
+JupyterHub with configurable latency and fake scancel/squeue binaries.
+Simulated browser tabs either request one route in a loop or, for the
+stream scenario, keep a slurm-provisioner/stream websocket open while the
+allocations file changes. Meanwhile a probe requests /api to measure how
+long requests wait for the event loop.
+
+Example:
+
+    python benchmarks/run.py --allocations 10 1000 10000 --tabs 1 10 50 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from tornado import web
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpclient import HTTPRequest
+from tornado.websocket import websocket_connect
+
+token = "slurmel-benchmark"
+username = "benchmark"
+servername = "bench"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def synthetic_allocations(count):
+    endtime = int(time.time()) + 24 * 3600
+    return {
+        str(1000000 + i): {
+            "config": {
+                "gpus": "0",
+                "jobid": str(1000000 + i),
+                "kernel": "Python 3",
+                "kernel_argv": ["python", "-m", "ipykernel_launcher", "-f", "{connection_file}"],
+                "kernel_language": "python",
+                "node": "None",
+                "nodes": "1",
+                "partition": "batch",
+                "project": "benchmark",
+                "reservation": "None",
+                "runtime": "60"
+            },
+            "endtime": endtime,
+            "kernel_ids": [str(uuid.uuid4()) for _ in range(3)],
+            "nodelist": [f"node{i % 1000:03d}"],
+            "state": "RUNNING"
+        }
+        for i in range(count)
+    }
+
+
+def write_allocations(home, allocations):
+    runtime_path = os.path.join(home, ".local/share/jupyter/runtime")
+    tmp_path = os.path.join(runtime_path, ".slurm_provisioner.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(allocations, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, os.path.join(runtime_path, "slurm_provisioner.json"))
+
+
+def prepare_home(home, bindir, allocations):
+    kernel_path = os.path.join(home, ".local/share/jupyter/kernels/slurm-provisioner-kernel")
+    runtime_path = os.path.join(home, ".local/share/jupyter/runtime")
+    os.makedirs(kernel_path, exist_ok=True)
+    os.makedirs(runtime_path, exist_ok=True)
+    jobid = next(iter(allocations), "None")
+    kernel = {
+        "display_name": "Slurm Wrapper",
+        "language": "python",
+        "metadata": {
+            "kernel_provisioner": {
+                "config": dict(allocations[jobid]["config"]) if jobid != "None" else {},
+                "provisioner_name": "slurm-provisioner"
+            }
+        }
+    }
+    with open(os.path.join(kernel_path, "kernel.json"), "w") as f:
+        json.dump(kernel, f, indent=4, sort_keys=True)
+    write_allocations(home, allocations)
+
+    # squeue reports every synthetic allocation as running, so nothing gets pruned
+    squeue_output = os.path.join(bindir, "squeue.out")
+    endtime = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() + 24 * 3600))
+    with open(squeue_output, "w") as f:
+        for jobid in allocations:
+            f.write(f"{jobid}|RUNNING|node[001-002]|{endtime}\n")
+    with open(os.path.join(bindir, "squeue"), "w") as f:
+        f.write(f"#!/bin/sh\ncat {squeue_output}\n")
+    with open(os.path.join(bindir, "scancel"), "w") as f:
+        f.write("#!/bin/sh\nexit 0\n")
+    for name in ("squeue", "scancel"):
+        os.chmod(os.path.join(bindir, name), 0o755)
+
+
+class OptionsFormHandler(web.RequestHandler):
+    def initialize(self, latency):
+        self.latency = latency
+
+    async def get(self, user, server):
+        await asyncio.sleep(self.latency)
+        self.finish({
+            "dropdown_lists": {
+                "projects": ["benchmark"],
+                "partitions": {"benchmark": ["batch"]},
+                "reservations": {}
+            },
+            "resources": {
+                "batch": {
+                    "nodes": {"default": 1, "minmax": [1, 32]},
+                    "runtime": {"default": 60, "minmax": [10, 1440]}
+                }
+            }
+        })
+
+
+def start_stub_hub(port, latency):
+    app = web.Application([
+        (r"/hub/api/users/([^/]+)/servers/([^/]*)/optionsform", OptionsFormHandler, {"latency": latency})
+    ])
+    return app.listen(port, address="127.0.0.1")
+
+
+def start_server(home, bindir, port, hub_port, args):
+    env = dict(
+        os.environ,
+        SLURMEL_OPTIONSFORM_TTL=str(args.optionsform_ttl),
+        SLURMEL_WATCH_INTERVAL=str(args.watch_interval),
+        HOME=home,
+        PATH=f"{bindir}{os.pathsep}{os.environ.get('PATH', '')}",
+        JUPYTERHUB_API_URL=f"http://127.0.0.1:{hub_port}/hub/api",
+        JUPYTERHUB_USER=username,
+        JUPYTERHUB_SERVER_NAME=servername,
+        JUPYTER_CONFIG_DIR=os.path.join(home, ".jupyter"),
+    )
+    cmd = [
+        sys.executable, "-m", "jupyter_server",
+        f"--ServerApp.port={port}",
+        "--ServerApp.ip=127.0.0.1",
+        f"--IdentityProvider.token={token}",
+        "--ServerApp.open_browser=False",
+        # benchmarks often run in containers as root
+        "--ServerApp.allow_root=True",
+        f"--ServerApp.root_dir={home}",
+        "--ServerApp.jpserver_extensions=jupyter_slurm_provisioner_extension=True",
+    ]
+    return subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def request(client, base_url, route, etags=None):
+    """Returns latency and success of one request.
+
+    With etags (a dict per tab), GET requests revalidate the last response
+    like the frontend does, so unchanged state costs a 304.
+    """
+    method, path, body = route
+    headers = {"Authorization": f"token {token}"}
+    if etags is not None and method == "GET":
+        headers["Accept-Encoding"] = "gzip"
+        if path in etags:
+            headers["If-None-Match"] = etags[path]
+    req = HTTPRequest(
+        url=f"{base_url}{path}",
+        method=method,
+        body=body,
+        headers=headers,
+        request_timeout=120,
+    )
+    start = time.perf_counter()
+    try:
+        response = await client.fetch(req, raise_error=False)
+    except Exception:
+        return time.perf_counter() - start, False
+    latency = time.perf_counter() - start
+    if etags is not None and response.code == 200 and "Etag" in response.headers:
+        etags[path] = response.headers["Etag"]
+    return latency, response.code in (200, 304)
+
+
+async def wait_for_server(client, base_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        _, ok = await request(client, base_url, ("GET", "/api", None))
+        if ok:
+            break
+        await asyncio.sleep(0.2)
+    else:
+        raise RuntimeError("Jupyter server did not start")
+    # without the extension every scenario would only measure 404s
+    response = await client.fetch(f"{base_url}/slurm-provisioner/local", raise_error=False,
+                                  headers={"Authorization": f"token {token}"})
+    if response.code == 404:
+        raise RuntimeError("slurm-provisioner server extension is not loaded")
+
+
+async def tab(client, base_url, route, interval, deadline, latencies, errors):
+    etags = {}
+    while time.monotonic() < deadline:
+        latency, ok = await request(client, base_url, route, etags)
+        latencies.append(latency)
+        if not ok:
+            errors.append(latency)
+        await asyncio.sleep(interval)
+
+
+async def probe(client, base_url, deadline, lags):
+    while time.monotonic() < deadline:
+        latency, _ = await request(client, base_url, ("GET", "/api", None))
+        lags.append(latency)
+        await asyncio.sleep(0.1)
+
+
+async def stream_tab(ws_url, deadline, changes, latencies, errors):
+    try:
+        conn = await websocket_connect(HTTPRequest(ws_url, headers={"Authorization": f"token {token}"}))
+    except Exception:
+        errors.append(None)
+        return
+    # full state on connect
+    await conn.read_message()
+    while time.monotonic() < deadline:
+        try:
+            message = await asyncio.wait_for(conn.read_message(), max(deadline - time.monotonic(), 0.01))
+        except asyncio.TimeoutError:
+            break
+        if message is None:
+            errors.append(None)
+            break
+        received = time.perf_counter()
+        allocations = json.loads(message).get("allocations", {})
+        for marker in {allocation.get("benchmark_marker") for allocation in allocations.values()}:
+            if marker in changes:
+                latencies.append(received - changes[marker])
+    conn.close()
+
+
+async def change_allocations(home, allocations, interval, deadline, changes):
+    """Rewrites the allocations file every interval with a new marker in one allocation."""
+    loop = asyncio.get_running_loop()
+    jobid = next(iter(allocations), None)
+    marker = 0
+    while jobid is not None and time.monotonic() < deadline:
+        await asyncio.sleep(interval)
+        marker += 1
+        allocations = dict(allocations, **{jobid: dict(allocations[jobid], benchmark_marker=marker)})
+        await loop.run_in_executor(None, write_allocations, home, allocations)
+        changes[marker] = time.perf_counter()
+
+
+async def run_scenario(client, base_url, name, route, tabs, interval, duration, home, allocations):
+    latencies, errors, lags = [], [], []
+    deadline = time.monotonic() + duration
+    start = time.perf_counter()
+    if name == "stream":
+        changes = {}
+        ws_url = base_url.replace("http://", "ws://") + route[1]
+        await asyncio.gather(
+            probe(client, base_url, deadline, lags),
+            change_allocations(home, allocations, interval, deadline, changes),
+            *[stream_tab(ws_url, deadline, changes, latencies, errors) for _ in range(tabs)]
+        )
+    else:
+        await asyncio.gather(
+            probe(client, base_url, deadline, lags),
+            *[tab(client, base_url, route, interval, deadline, latencies, errors) for _ in range(tabs)]
+        )
+    elapsed = time.perf_counter() - start
+    ms = 1000
+    return {
+        "route": name,
+        "tabs": tabs,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "throughput_rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * ms if latencies else None,
+        "p99_ms": percentile(latencies, 99) * ms if latencies else None,
+        "mean_ms": statistics.mean(latencies) * ms if latencies else None,
+        "event_loop_lag_p50_ms": percentile(lags, 50) * ms if lags else None,
+        "event_loop_lag_p99_ms": percentile(lags, 99) * ms if lags else None,
+    }
+
+
+def routes(kernel_id="unknown"):
+    configure = json.dumps({
+        "jobid": "None", "node": "None", "kernel": "Python 3", "kernel_argv": [], "kernel_language": "python",
+        "project": "benchmark", "partition": "batch", "nodes": "1", "gpus": "0", "runtime": "60",
+        "reservation": "None"
+    })
+    return {
+        "local": ("GET", "/slurm-provisioner/local", None),
+        "all": ("GET", "/slurm-provisioner/all", None),
+        "configure": ("POST", "/slurm-provisioner/configure", configure),
+        # unknown jobids: the allocations file stays the same for every request
+        "scancel": ("POST", "/slurm-provisioner/scancel", json.dumps({"jobid": "1"})),
+        # kernel of the last allocation, like a notebook toolbar looking up its allocation
+        "kernel": ("GET", f"/slurm-provisioner/kernel/{kernel_id}", None),
+        # websockets receiving the changes of the allocations file (latency: change -> message)
+        "stream": ("WS", "/slurm-provisioner/stream", None),
+    }
+
+
+async def main(args):
+    hub_port = free_port()
+    hub = start_stub_hub(hub_port, args.hub_latency)
+    AsyncHTTPClient.configure(None, max_clients=max(args.tabs) + 10)
+    client = AsyncHTTPClient()
+    results = []
+    try:
+        for count in args.allocations:
+            tmpdir = tempfile.mkdtemp(prefix="slurmel-bench-")
+            home = os.path.join(tmpdir, "home")
+            bindir = os.path.join(tmpdir, "bin")
+            os.makedirs(home)
+            os.makedirs(bindir)
+            allocations = synthetic_allocations(count)
+            prepare_home(home, bindir, allocations)
+            kernel_id = allocations[next(reversed(allocations))]["kernel_ids"][0] if allocations else "unknown"
+            port = free_port()
+            base_url = f"http://127.0.0.1:{port}"
+            server = start_server(home, bindir, port, hub_port, args)
+            try:
+                await wait_for_server(client, base_url)
+                for name, route in routes(kernel_id).items():
+                    if name not in args.routes:
+                        continue
+                    for tabs in args.tabs:
+                        result = await run_scenario(client, base_url, name, route, tabs, args.interval,
+                                                    args.duration, home, allocations)
+                        result["allocations"] = count
+                        result["hub_latency_s"] = args.hub_latency
+                        results.append(result)
+                        print(json.dumps(result), file=sys.stderr)
+            finally:
+                server.terminate()
+                server.wait()
+                shutil.rmtree(tmpdir, ignore_errors=True)
+    finally:
+        hub.stop()
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], text=True,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        commit = None
+    return {
+        "commit": commit,
+        "settings": {
+            "interval_s": args.interval,
+            "duration_s": args.duration,
+            "hub_latency_s": args.hub_latency,
+            "optionsform_ttl_s": args.optionsform_ttl,
+            "watch_interval_s": args.watch_interval,
+        },
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--allocations", type=int, nargs="+", default=[10, 100, 1000, 10000],
+                        help="sizes of the synthetic allocations file")
+    parser.add_argument("--tabs", type=int, nargs="+", default=[1, 10, 50],
+                        help="number of simulated browser tabs")
+    parser.add_argument("--routes", nargs="+", default=list(routes().keys()), choices=list(routes().keys()))
+    parser.add_argument("--interval", type=float, default=2.0,
+                        help="seconds between two requests of one tab, or between two changes of the "
+                             "allocations file in the stream scenario")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per scenario")
+    parser.add_argument("--hub-latency", type=float, default=0.5, help="latency of the stub hub in seconds")
+    parser.add_argument("--optionsform-ttl", type=float, default=300,
+                        help="SLURMEL_OPTIONSFORM_TTL of the server; with 0 every /all request revalidates "
+                             "the options form at the stub hub")
+    parser.add_argument("--watch-interval", type=float, default=2,
+                        help="SLURMEL_WATCH_INTERVAL of the server, used by the stream scenario")
+    parser.add_argument("--output", help="write the results as JSON to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -8,7 +8,7 @@ except ImportError:
 
     warnings.warn("Importing 'jupyter_slurm_provisioner_extension' outside a proper installation.")
     __version__ = "dev"
-from .handlers import setup_handlers, setup_kernel
+from .handlers import setup_handlers, setup_kernel, stop_background_tasks
 
 
 def _jupyter_labextension_paths():
@@ -37,3 +37,14 @@ def _load_jupyter_server_extension(server_app):
 
     name = "jupyter_slurm_provisioner_extension"
     server_app.log.info(f"Registered {name} server extension")
+
+
+def _unload_jupyter_server_extension(server_app):
+    """Stops the background tasks started by the handlers.
+
+    Parameters
+    ----------
+    server_app: jupyter_server.serverapp.ServerApp
+        JupyterLab application instance
+    """
+    stop_background_tasks(server_app.web_app.settings.get("slurmel_tasks", []))
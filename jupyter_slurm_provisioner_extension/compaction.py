@@ -0,0 +1,35 @@
+import asyncio
+
+from .execution import run_io
+
+
+class Compactor:
+    """Shared background task keeping the allocations file small.
+
+    Every interval, expired allocations and dead kernel IDs older than
+    retention seconds are moved to the archive file by StateStore.compact.
+    """
+
+    def __init__(self, store, interval, retention):
+        self.store = store
+        self.interval = interval
+        self.retention = retention
+        self._task = None
+
+    def ensure_started(self, logger):
+        if self._task is not None:
+            return
+        self._task = asyncio.ensure_future(self._run(logger))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+        self._task = None
+
+    async def _run(self, logger):
+        while True:
+            try:
+                await run_io(self.store.compact, self.retention, logger)
+            except Exception:
+                logger.exception("Slurmel: Could not compact allocations")
+            await asyncio.sleep(self.interval)
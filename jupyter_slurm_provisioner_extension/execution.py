@@ -0,0 +1,69 @@
+import asyncio
+import contextlib
+import functools
+import os
+import signal
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+
+io_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("SLURMEL_IO_WORKERS", "4")),
+    thread_name_prefix="slurmel-io"
+)
+command_timeout = float(os.environ.get("SLURMEL_COMMAND_TIMEOUT", "30"))
+
+
+class CommandError(Exception):
+    def __init__(self, cmd, message, returncode=None):
+        super().__init__(f"{' '.join(cmd)}: {message}")
+        self.cmd = cmd
+        self.message = message
+        self.returncode = returncode
+
+
+async def run_io(func, *args, **kwargs):
+    """Runs blocking (file system) work on the bounded io executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, functools.partial(func, *args, **kwargs))
+
+
+async def run_command(cmd, timeout=None):
+    """Runs cmd without blocking the event loop and returns its stdout.
+
+    Raises CommandError if the command cannot be started, exits with a
+    non-zero returncode or does not finish within timeout seconds.
+    """
+    if timeout is None:
+        timeout = command_timeout
+    start = time.perf_counter()
+    try:
+        return await _run_command(cmd, timeout)
+    finally:
+        metrics.command_duration.observe(time.perf_counter() - start, os.path.basename(cmd[0]))
+
+
+async def _run_command(cmd, timeout):
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True
+        )
+    except OSError as e:
+        raise CommandError(cmd, str(e))
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        # Kill the whole process group, children would keep the pipes open
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(proc.pid, signal.SIGKILL)
+        await proc.wait()
+        raise CommandError(cmd, f"timed out after {timeout} seconds")
+    if proc.returncode != 0:
+        message = stderr.decode("utf8", "replace").strip() or f"exit code {proc.returncode}"
+        raise CommandError(cmd, message, proc.returncode)
+    return stdout.decode("utf8", "replace")
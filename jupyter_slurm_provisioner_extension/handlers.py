@@ -1,103 +1,293 @@
+import asyncio
 import base64
+import contextlib
+import gzip
 import json
 import os
 import shutil
-import subprocess
+import time
 
 from jupyter_server.base.handlers import APIHandler
+from jupyter_server.base.handlers import JupyterHandler
 from jupyter_server.utils import url_path_join
 
-from datetime import datetime
 from tornado import web
+from tornado import websocket
 from tornado.httpclient import AsyncHTTPClient
 from tornado.httpclient import HTTPRequest
+from tornado.ioloop import PeriodicCallback
+
+from . import metrics
+from .compaction import Compactor
+from .execution import run_io
+from .scancel import is_gone
+from .scancel import scancel
+from .squeue import SqueuePoller
+from .store import StateStore
+
+# Smaller responses are not worth compressing
+gzip_min_size = 1024
 
 current_config_file = os.path.expanduser("~/.local/share/jupyter/kernels/slurm-provisioner-kernel/kernel.json")
-current_config = [0, {}]
 allocations_file = os.path.expanduser("~/.local/share/jupyter/runtime/slurm_provisioner.json")
-allocations = [0, {}]
-
-
-def get_current_config(logger):
-    try:
-        last_edit = os.stat(current_config_file).st_mtime
-        if last_edit > current_config[0]:
-            current_config[0] = last_edit
-            with open(current_config_file, "r") as f:
-                kernel_json = json.load(f)
-            current_config[1] = kernel_json.get("metadata", {}).get("kernel_provisioner", {}).get("config", {})
-    except Exception:
-        logger.exception("Could not read slurm-provisioner-kernel/kernel.json file")
-    return current_config[1]
-
-
-def get_allocations(logger):
-    try:
-        last_edit = os.stat(allocations_file).st_mtime
-        if last_edit > allocations[0]:
-            allocations[0] = last_edit
-            with open(allocations_file, "r") as f:
-                allocations[1] = json.load(f)
-    except Exception:
-        logger.exception("Could not read runtime/slurm_provisioner.json file")
-    return allocations[1]
-
-
-def sanitize_allocations(logger):
-    # get current config
-    config = get_current_config(logger)
-    now = datetime.now().timestamp()
-    current_jobid = config.get("jobid", "None")
-
-    # If the selected allocation is not available, we'll reset the current config partially
-    allocations = get_allocations(logger)
-
-    # a job must be selected
-    if current_jobid != "None":
-        endtime = allocations.get(current_jobid, {}).get("endtime", now)
-        # an endtime must be set (if it's null/None, it's not started yet)
-        if endtime:
-            # selected job, which has been run in the past, is not in allocations or finished
-            if current_jobid not in allocations.keys() or endtime < now:
-                # Endtime of current jobid is in the past. So we'll update the current config (kernel.json)
-                config["jobid"] = "None"
-                config["node"] = "None"
-                with open(current_config_file, "r") as f:
-                    kernel_json = json.load(f)
-                if "metadata" not in kernel_json.keys():
-                    kernel_json["metadata"] = {}
-                if "kernel_provisioner" not in kernel_json["metadata"].keys():
-                    kernel_json["metadata"]["kernel_provisioner"] = {}
-                kernel_json["metadata"]["kernel_provisioner"]["config"] = config
-                with open(current_config_file, "w") as f:
-                    f.write(json.dumps(kernel_json, indent=4, sort_keys=True))
-
-
-class UpdateLocalFiles(APIHandler):
-    @web.authenticated
-    async def get(self):
-        sanitize_allocations(self.log)
-        body = {
-            "current_config": get_current_config(self.log),
-            "allocations": get_allocations(self.log)
-        }
-        await self.finish(json.dumps(body))
+archive_file = os.path.expanduser("~/.local/share/jupyter/runtime/slurm_provisioner_archive.json")
+
+
+def start_background_tasks(tasks, logger):
+    """Starts the shared SqueuePoller and Compactor with the first request."""
+    for task in tasks:
+        task.ensure_started(logger)
+
+
+def stop_background_tasks(tasks):
+    for task in tasks:
+        task.stop()
+
+
+class SlurmelAPIHandler(APIHandler):
+    """Base class of the slurm-provisioner API handlers.
+
+    Counts requests and their latency per route and sends a Server-Timing
+    header containing the steps measured with timing().
+    """
+
+    route = None
+    # Set in prepare(), which is skipped e.g. for unsupported methods
+    _start = None
+    server_timings = None
+    etag_version = None
+
+    def prepare(self):
+        self._start = time.perf_counter()
+        self.server_timings = {}
+        self.etag_version = None
+        return super().prepare()
+
+    @contextlib.contextmanager
+    def timing(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.server_timings[name] = self.server_timings.get(name, 0) + time.perf_counter() - start
+
+    @property
+    def accepts_gzip(self):
+        return "gzip" in self.request.headers.get("Accept-Encoding", "")
+
+    def check_version(self, version):
+        """Sets a strong ETag for version. Returns True if the client has it already.
+
+        Compressed bodies get the ETag "<version>-gzip" (see finish_json), so
+        both forms are accepted from clients accepting gzip.
+        """
+        self.etag_version = version
+        self.set_header("Vary", "Accept-Encoding")
+        etags = [f'"{version}-gzip"', f'"{version}"'] if self.accepts_gzip else [f'"{version}"']
+        for etag in etags:
+            self.set_header("Etag", etag)
+            if self.check_etag_header():
+                return True
+        return False
+
+    async def finish_json(self, data):
+        """Finishes with data as JSON, gzip compressed for large bodies if the client accepts it."""
+        body = json.dumps(data).encode("utf8")
+        if len(body) >= gzip_min_size and self.accepts_gzip:
+            with self.timing("gzip"):
+                body = await run_io(gzip.compress, body, 6)
+            self.set_header("Content-Encoding", "gzip")
+            if self.etag_version is not None:
+                self.set_header("Etag", f'"{self.etag_version}-gzip"')
+        await self.finish(body)
+
+    def finish(self, *args, **kwargs):
+        if self._start is not None:
+            timings = dict(self.server_timings, total=time.perf_counter() - self._start)
+            self.set_header("Server-Timing", ", ".join(f"{name};dur={duration * 1000:.1f}"
+                                                      for name, duration in timings.items()))
+        return super().finish(*args, **kwargs)
+
+    def on_finish(self):
+        metrics.requests_total.inc(self.route, str(self.get_status()))
+        if self._start is not None:
+            metrics.request_duration.observe(time.perf_counter() - self._start, self.route)
+        super().on_finish()
+
+
+class StateWatcher:
+    """Watches kernel.json and the allocations file once per server.
+
+    Subscribers (the StateStream websockets) receive the full state when
+    they connect and afterwards only the allocations changed or removed
+    since the last message, in the format of StateStore.changes_since.
+    The files are polled via os.stat, because inotify on GPFS does not
+    report changes written from other nodes. Polling only runs while at
+    least one client is connected.
+    """
+
+    def __init__(self, store, tasks, interval):
+        self.store = store
+        self.tasks = tasks
+        self.interval = interval
+        self.subscribers = set()
+        self.version = None
+        self._full = (None, None)
+        self._callback = None
+
+    async def check(self, logger):
+        if self.version is None:
+            state = await run_io(self.store.snapshot, logger)
+        else:
+            state = await run_io(self.store.changes_since, self.version, logger)
+        if state["version"] == self.version:
+            return
+        self.version = state["version"]
+        message = await run_io(json.dumps, state)
+        for subscriber in list(self.subscribers):
+            subscriber.send(message)
+
+    async def full_state(self, logger):
+        """Returns the full state as JSON, serialized once per version."""
+        version, message = self._full
+        if version is None or version != self.version:
+            state = await run_io(self.store.snapshot, logger)
+            message = await run_io(json.dumps, state)
+            self._full = (state["version"], message)
+        return message
+
+    async def subscribe(self, subscriber):
+        if self._callback is None:
+            logger = subscriber.log
+            start_background_tasks(self.tasks, logger)
+            self._callback = PeriodicCallback(lambda: self.check(logger), self.interval * 1000)
+            self._callback.start()
+            await self.check(logger)
+        self.subscribers.add(subscriber)
+        subscriber.send(await self.full_state(subscriber.log))
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        if not self.subscribers and self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+
+class StateStream(JupyterHandler, websocket.WebSocketHandler):
+    def initialize(self, watcher):
+        self.watcher = watcher
+
+    async def pre_get(self):
+        if self.current_user is None:
+            self.log.warning("Slurmel: Couldn't authenticate WebSocket connection")
+            raise web.HTTPError(403)
+
+    async def get(self, *args, **kwargs):
+        await self.pre_get()
+        res = super().get(*args, **kwargs)
+        if res is not None:
+            await res
+
+    async def open(self):
+        await self.watcher.subscribe(self)
+
+    def send(self, message):
+        try:
+            self.write_message(message)
+        except websocket.WebSocketClosedError:
+            self.watcher.unsubscribe(self)
 
+    def on_close(self):
+        self.watcher.unsubscribe(self)
+
+
+class UpdateLocalFiles(SlurmelAPIHandler):
+    route = "local"
+
+    def initialize(self, store, tasks):
+        self.store = store
+        self.tasks = tasks
 
-class UpdateAll(APIHandler):
     @web.authenticated
     async def get(self):
-        headers = {
-            "Authorization": self.request.headers.get("Authorization")
-        }
+        start_background_tasks(self.tasks, self.log)
+        since = self.get_argument("since", None)
+        with self.timing("io"):
+            if since:
+                body = await run_io(self.store.changes_since, since, self.log)
+            else:
+                body = await run_io(self.store.snapshot, self.log)
+        if self.check_version(body["version"]):
+            self.set_status(304)
+            await self.finish()
+            return
+        await self.finish_json(body)
 
-        servername = os.environ.get("JUPYTERHUB_SERVER_NAME", None)
-        username = os.environ.get("JUPYTERHUB_USER", None)
-        api_url = os.environ.get("JUPYTERHUB_API_URL", f"{self.request.protocol}://{self.request.host}/hub/api").rstrip(
-            "/")
-        url = f"{api_url}/users/{username}/servers/{servername}/optionsform"
 
-        # Receive current options form for this user + system
+class KernelAllocationHandler(SlurmelAPIHandler):
+    """Returns the allocation a kernel runs in, found via the kernel ID index of the store."""
+    route = "kernel"
+
+    def initialize(self, store, tasks):
+        self.store = store
+        self.tasks = tasks
+
+    @web.authenticated
+    async def get(self, kernel_id):
+        start_background_tasks(self.tasks, self.log)
+        with self.timing("io"):
+            version, found = await run_io(self.store.find_kernel, kernel_id, self.log)
+        if found is None:
+            raise web.HTTPError(404, f"No allocation found for kernel {kernel_id}")
+        if self.check_version(version):
+            self.set_status(304)
+            await self.finish()
+            return
+        jobid, allocation = found
+        await self.finish_json({
+            "jobid": jobid,
+            "endtime": allocation.get("endtime", None),
+            "state": allocation.get("state", None),
+            "nodelist": allocation.get("nodelist", [])
+        })
+
+
+class OptionsFormCache:
+    """Caches the JupyterHub options form per server url.
+
+    Returns the options form and its version, which changes whenever the
+    hub sends a different options form.
+    Entries younger than ``ttl`` seconds are served directly. Older entries
+    are served as they are while one background request revalidates them
+    (using If-None-Match, if the hub sent an ETag). Concurrent callers share
+    the in-flight request. If the hub is slow or down, the last good copy
+    stays in use. After a failed request the hub is asked again after
+    ``retry_interval`` seconds, doubled with every further failure up to
+    ``ttl``.
+    """
+
+    def __init__(self, ttl, retry_interval):
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.entries = {}
+
+    async def get(self, url, headers, logger):
+        entry = self.entries.setdefault(url, {"fetched": None, "inflight": None, "version": 0, "failures": 0,
+                                              "retry_at": None})
+        now = time.monotonic()
+        if entry["fetched"] is not None and now - entry["fetched"] < self.ttl:
+            return entry["body"], entry["version"]
+        if entry["inflight"] is None and (entry["retry_at"] is None or now >= entry["retry_at"]):
+            entry["inflight"] = asyncio.ensure_future(self._fetch(entry, url, headers, logger))
+        if "body" in entry or entry["inflight"] is None:
+            # stale-while-revalidate, or the hub failed recently
+            return entry.get("body", {}), entry["version"]
+        return await asyncio.shield(entry["inflight"])
+
+    async def _fetch(self, entry, url, headers, logger):
+        headers = dict(headers)
+        if entry.get("etag") and "body" in entry:
+            headers["If-None-Match"] = entry["etag"]
         req = HTTPRequest(
             url=url,
             method="GET",
@@ -105,68 +295,157 @@ class UpdateAll(APIHandler):
             validate_cert=False,
         )
         http_client = AsyncHTTPClient()
+        start = time.perf_counter()
         try:
-            resp = await http_client.fetch(req)
-            if resp.body:
-                body = json.loads(resp.body.decode('utf8', 'replace'))
+            resp = await http_client.fetch(req, raise_error=False)
+            metrics.hub_request_duration.observe(time.perf_counter() - start)
+            if resp.code == 304 and "body" in entry:
+                pass
+            elif resp.code == 200:
+                if resp.body:
+                    body = json.loads(resp.body.decode('utf8', 'replace'))
+                else:
+                    body = {}
+                if body != entry.get("body", None):
+                    entry["body"] = body
+                    entry["version"] += 1
+                entry["etag"] = resp.headers.get("Etag", None)
             else:
-                body = {}
+                resp.rethrow()
+            entry["fetched"] = time.monotonic()
+            entry["failures"] = 0
+            entry["retry_at"] = None
         except Exception:
-            self.log.exception("Slurmel: Could not receive OptionsForm information")
-            body = {}
+            metrics.hub_request_errors.inc()
+            entry["failures"] += 1
+            backoff = min(self.retry_interval * 2 ** (entry["failures"] - 1), max(self.ttl, self.retry_interval))
+            entry["retry_at"] = time.monotonic() + backoff
+            logger.exception(f"Slurmel: Could not receive OptionsForm information, next try in {backoff} seconds")
+        finally:
+            entry["inflight"] = None
+        return entry.get("body", {}), entry["version"]
+
+
+options_form_cache = OptionsFormCache(
+    float(os.environ.get("SLURMEL_OPTIONSFORM_TTL", "300")),
+    float(os.environ.get("SLURMEL_OPTIONSFORM_RETRY_INTERVAL", "5"))
+)
+
+
+class UpdateAll(SlurmelAPIHandler):
+    route = "all"
 
-        body["allocations"] = get_allocations(self.log)
-        body["current_config"] = get_current_config(self.log)
+    def initialize(self, store, tasks):
+        self.store = store
+        self.tasks = tasks
+
+    @web.authenticated
+    async def get(self):
+        start_background_tasks(self.tasks, self.log)
+        headers = {
+            "Authorization": self.request.headers.get("Authorization")
+        }
+
+        servername = os.environ.get("JUPYTERHUB_SERVER_NAME", None)
+        username = os.environ.get("JUPYTERHUB_USER", None)
+        api_url = os.environ.get("JUPYTERHUB_API_URL", f"{self.request.protocol}://{self.request.host}/hub/api").rstrip(
+            "/")
+        url = f"{api_url}/users/{username}/servers/{servername}/optionsform"
+
+        # Receive current options form for this user + system
+        with self.timing("hub"):
+            options_form, options_form_version = await options_form_cache.get(url, headers, self.log)
+
+        with self.timing("io"):
+            state = await run_io(self.store.snapshot, self.log)
+        if self.check_version(f"{state['version']}.{options_form_version}"):
+            self.set_status(304)
+            await self.finish()
+            return
+        body = dict(options_form)
+        body["allocations"] = state["allocations"]
+        body["current_config"] = state["current_config"]
         body["documentationhref"] = os.environ.get("SLURMEL_DOCUMENTATION_HREF", "slurmeldocumentation")
-        await self.finish(json.dumps(body))
+        await self.finish_json(body)
+
+
+class ConfigureHandler(SlurmelAPIHandler):
+    route = "configure"
 
+    def initialize(self, store):
+        self.store = store
 
-class ConfigureHandler(APIHandler):
     @web.authenticated
     async def post(self):
-        # load current json kernel file
-        home = os.environ.get("HOME", "").rstrip("/")
-        kernel_path = f"{home}/.local/share/jupyter/kernels/slurm-provisioner-kernel"
-        with open(f"{kernel_path}/kernel.json", "r") as f:
-            kernel = json.load(f)
-
         if self.request.body:
             new_config = json.loads(self.request.body.decode('utf8', 'replace'))
         else:
             self.log.error("Slurmel: No body sent")
             self.set_status(400)
             return
-        kernel["metadata"]["kernel_provisioner"]["config"] = new_config
-        with open(f"{kernel_path}/kernel.json", "w") as f:
-            f.write(json.dumps(kernel, indent=4, sort_keys=True))
+        with self.timing("io"):
+            await run_io(self.store.set_current_config, new_config, self.log)
         self.set_status(200)
 
 
-class SCancelHandler(APIHandler):
+class SCancelHandler(SlurmelAPIHandler):
+    """Cancels one ({"jobid": ...}) or many ({"jobids": [...]}) jobs.
+
+    The allocations file is updated once per request, after scancel ran.
+    Only jobs which were cancelled or are unknown to Slurm are removed.
+    For "jobids" the response reports success or failure per job.
+    """
+
+    route = "scancel"
+
+    def initialize(self, store, batch_size, parallel):
+        self.store = store
+        self.batch_size = batch_size
+        self.parallel = parallel
+
     @web.authenticated
     async def post(self):
         if self.request.body:
-            body = json.loads(self.request.body.decode('utf8', 'replace'))
+            try:
+                body = json.loads(self.request.body.decode('utf8', 'replace'))
+            except ValueError:
+                raise web.HTTPError(400, "Body must be JSON")
         else:
             self.log.error("Slurmel: No body sent")
             self.set_status(400)
             return
+        if not isinstance(body, dict):
+            raise web.HTTPError(400, "Body must be a JSON object")
 
-        allocations_file = f"{os.environ.get('HOME', '')}/.local/share/jupyter/runtime/slurm_provisioner.json"
-        with open(allocations_file, "r") as f:
-            allocs = json.load(f)
-
-        jobid = body.get("jobid", None)
-        if jobid in allocs.keys():
-            del allocs[body["jobid"]]
+        if "jobids" in body.keys():
+            if not isinstance(body["jobids"], list):
+                raise web.HTTPError(400, "jobids must be a list")
+            jobids = list(dict.fromkeys(str(jobid) for jobid in body["jobids"] if jobid))
+        else:
+            jobid = body.get("jobid", None)
+            jobids = [str(jobid)] if jobid else []
+
+        with self.timing("scancel"):
+            results = await scancel(jobids, self.batch_size, self.parallel)
+        for jobid, result in results.items():
+            if not result["success"]:
+                self.log.error(f"Slurmel: Could not cancel job {jobid}: {result['message']}")
+        with self.timing("io"):
+            await run_io(self.store.remove_allocations, [jobid for jobid in jobids if is_gone(results[jobid])],
+                         self.log)
+
+        if "jobids" in body.keys():
+            await self.finish(json.dumps({"results": results}))
+        elif jobids and not results[jobids[0]]["success"]:
+            raise web.HTTPError(500, results[jobids[0]]["message"])
+        else:
+            self.set_status(200)
 
-        with open(allocations_file, "w") as f:
-            f.write(json.dumps(allocs, indent=2, sort_keys=True))
 
-        if jobid:
-            scancel_cmd = ["scancel", jobid]
-            subprocess.check_output(scancel_cmd)
-        self.set_status(200)
+class MetricsHandler(APIHandler):
+    @web.authenticated
+    async def get(self):
+        await self.finish(metrics.generate_latest(), set_content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 def default_kernel():
@@ -225,9 +504,31 @@ def setup_handlers(web_app):
         web_app.settings["base_url"],
         "slurm-provisioner"  # API Namespace
     )
+    store = StateStore(current_config_file, allocations_file, archive_file)
+    poller = SqueuePoller(
+        store,
+        float(os.environ.get("SLURMEL_SQUEUE_INTERVAL", "30")),
+        float(os.environ.get("SLURMEL_SQUEUE_MAX_INTERVAL", "300"))
+    )
+    compactor = Compactor(
+        store,
+        float(os.environ.get("SLURMEL_COMPACT_INTERVAL", "3600")),
+        float(os.environ.get("SLURMEL_ALLOCATIONS_RETENTION", "86400"))
+    )
+    tasks = [poller, compactor]
+    web_app.settings["slurmel_tasks"] = tasks
+    scancel_kwargs = {
+        "store": store,
+        "batch_size": int(os.environ.get("SLURMEL_SCANCEL_BATCH_SIZE", "100")),
+        "parallel": int(os.environ.get("SLURMEL_SCANCEL_PARALLEL", "4"))
+    }
+    watcher = StateWatcher(store, tasks, float(os.environ.get("SLURMEL_WATCH_INTERVAL", "2")))
     web_app.add_handlers(".*$", [
-        (url_path_join(base_url, "configure"), ConfigureHandler),
-        (url_path_join(base_url, "local"),     UpdateLocalFiles),
-        (url_path_join(base_url, "all"),       UpdateAll),
-        (url_path_join(base_url, "scancel"),   SCancelHandler)
+        (url_path_join(base_url, "configure"), ConfigureHandler, {"store": store}),
+        (url_path_join(base_url, "local"),     UpdateLocalFiles, {"store": store, "tasks": tasks}),
+        (url_path_join(base_url, "all"),       UpdateAll,        {"store": store, "tasks": tasks}),
+        (url_path_join(base_url, r"kernel/([^/]+)"), KernelAllocationHandler, {"store": store, "tasks": tasks}),
+        (url_path_join(base_url, "scancel"),   SCancelHandler,   scancel_kwargs),
+        (url_path_join(base_url, "stream"),    StateStream,      {"watcher": watcher}),
+        (url_path_join(base_url, "metrics"),   MetricsHandler)
     ])
@@ -0,0 +1,108 @@
+import threading
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+               for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labelvalues, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            if labelvalues not in self.values:
+                # bucket counts, sum, count
+                self.values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            entry = self.values[labelvalues]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labelvalues, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _format_labels(self.labelnames, labelvalues, [("le", bound)])
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _format_labels(self.labelnames, labelvalues, [("le", "+Inf")])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labelnames, labelvalues)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+requests_total = Counter(
+    "slurmel_requests_total", "Requests to the slurm-provisioner API", ("route", "status"))
+request_duration = Histogram(
+    "slurmel_request_duration_seconds", "Latency of the slurm-provisioner API", ("route",))
+hub_request_duration = Histogram(
+    "slurmel_hub_request_duration_seconds", "Latency of the JupyterHub options form request")
+hub_request_errors = Counter(
+    "slurmel_hub_request_errors_total", "Failed JupyterHub options form requests")
+json_parses = Counter(
+    "slurmel_json_parses_total", "JSON files parsed", ("file",))
+json_writes = Counter(
+    "slurmel_json_writes_total", "JSON files written", ("file",))
+file_cache = Counter(
+    "slurmel_file_cache_total", "File snapshot lookups, hit if the file identity did not change", ("file", "result"))
+config_resets = Counter(
+    "slurmel_config_resets_total", "Resets of the selected allocation in kernel.json by sanitize")
+command_duration = Histogram(
+    "slurmel_command_duration_seconds", "Duration of subprocesses like scancel and squeue", ("command",))
+
+registry = [
+    requests_total,
+    request_duration,
+    hub_request_duration,
+    hub_request_errors,
+    json_parses,
+    json_writes,
+    file_cache,
+    config_resets,
+    command_duration,
+]
+
+
+def generate_latest():
+    """Returns all metrics in the Prometheus text format."""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
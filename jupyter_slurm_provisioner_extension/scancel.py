@@ -0,0 +1,49 @@
+import asyncio
+import re
+
+from .execution import CommandError
+from .execution import run_command
+
+# scancel: error: Kill job error on job id 123: Invalid job id specified
+job_error = re.compile(r"job id (\S+?): (.*)$")
+# Errors for jobs Slurm does not run any longer
+job_gone = re.compile(r"Invalid job id|already completing or completed", re.IGNORECASE)
+
+
+def is_gone(result):
+    """True if the job of a scancel result was cancelled or is unknown to Slurm."""
+    return result["success"] or bool(job_gone.search(result["message"]))
+
+
+async def _scancel_batch(jobids, semaphore):
+    async with semaphore:
+        try:
+            await run_command(["scancel"] + jobids)
+        except CommandError as e:
+            errors = {}
+            for line in e.message.splitlines():
+                match = job_error.search(line)
+                if match and match.group(1) in jobids:
+                    errors[match.group(1)] = match.group(2).strip()
+            if not errors:
+                # Timeout, scancel not available, ...: nothing is known about single jobs
+                errors = {jobid: e.message for jobid in jobids}
+            return {
+                jobid: {"success": jobid not in errors, "message": errors.get(jobid, "")}
+                for jobid in jobids
+            }
+    return {jobid: {"success": True, "message": ""} for jobid in jobids}
+
+
+async def scancel(jobids, batch_size, parallel):
+    """Cancels jobids with as few scancel calls as possible.
+
+    The jobids are split into batches of batch_size, of which at most
+    parallel run at the same time. Returns {jobid: {"success", "message"}}.
+    """
+    semaphore = asyncio.Semaphore(parallel)
+    batches = [jobids[i:i + batch_size] for i in range(0, len(jobids), batch_size)]
+    results = {}
+    for batch_results in await asyncio.gather(*[_scancel_batch(batch, semaphore) for batch in batches]):
+        results.update(batch_results)
+    return results
@@ -0,0 +1,100 @@
+import asyncio
+import re
+import shutil
+
+from datetime import datetime
+
+from .execution import CommandError
+from .execution import run_command
+from .execution import run_io
+
+squeue_format = "%i|%T|%N|%e"
+
+
+def expand_hostlist(hostlist):
+    """Expands a compressed Slurm hostlist like "jwc[01-03,07],jwlogin1"."""
+    hosts = []
+    for prefix, ranges, suffix in re.findall(r"([^,\[]+)(?:\[([^\]]+)\])?([^,\[]*)", hostlist):
+        if not ranges:
+            hosts.append(f"{prefix}{suffix}")
+            continue
+        for part in ranges.split(","):
+            if "-" in part:
+                start, end = part.split("-", 1)
+                for i in range(int(start), int(end) + 1):
+                    hosts.append(f"{prefix}{str(i).zfill(len(start))}{suffix}")
+            else:
+                hosts.append(f"{prefix}{part}{suffix}")
+    return hosts
+
+
+def parse_squeue(output):
+    jobs = {}
+    for line in output.splitlines():
+        fields = line.strip().split("|")
+        if len(fields) != 4:
+            continue
+        jobid, state, nodelist, endtime = fields
+        try:
+            endtime = datetime.strptime(endtime, "%Y-%m-%dT%H:%M:%S").timestamp()
+        except ValueError:
+            # N/A, Unknown or NONE for jobs which did not start yet
+            endtime = None
+        jobs[jobid] = {
+            "state": state,
+            "nodelist": expand_hostlist(nodelist) if nodelist else [],
+            "endtime": endtime
+        }
+    return jobs
+
+
+class SqueuePoller:
+    """Shared background task reconciling the allocations with Slurm.
+
+    One `squeue --me` query per interval serves all clients of this server.
+    The result is handed to the StateStore, which overlays state, nodelist
+    and endtime of the allocations and prunes jobs Slurm does not know any
+    longer. While squeue fails (e.g. slurmctld is overloaded) the interval
+    is doubled up to max_interval and the last result stays in use.
+    """
+
+    def __init__(self, store, interval, max_interval):
+        self.store = store
+        self.interval = interval
+        self.max_interval = max_interval
+        self._task = None
+
+    def ensure_started(self, logger):
+        if self._task is not None:
+            return
+        if not shutil.which("squeue"):
+            logger.info("Slurmel: squeue not found, allocations are not reconciled with Slurm")
+            self._task = False
+            return
+        self._task = asyncio.ensure_future(self._run(logger))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+        self._task = None
+
+    async def _run(self, logger):
+        interval = self.interval
+        while True:
+            try:
+                await self.poll(logger)
+                interval = self.interval
+            except CommandError as e:
+                interval = min(interval * 2, self.max_interval)
+                logger.warning(f"Slurmel: squeue failed, next try in {interval} seconds: {e}")
+            except Exception:
+                logger.exception("Slurmel: Could not reconcile allocations")
+            await asyncio.sleep(interval)
+
+    async def poll(self, logger):
+        # Only allocations known before the query may be pruned. Jobs submitted
+        # while squeue is running are not part of its output yet.
+        queried = set((await run_io(self.store.get_allocations, logger)).keys())
+        output = await run_command(["squeue", "--me", "--noheader", f"--format={squeue_format}"])
+        await run_io(self.store.update_jobs, parse_squeue(output), queried, logger)
+
@@ -0,0 +1,347 @@
+import copy
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from datetime import datetime
+
+from jupyter_core.paths import jupyter_runtime_dir
+
+from . import metrics
+
+# Removed allocations remembered for changes_since. Clients with an older
+# version get the full snapshot.
+removed_limit = 1000
+
+# Connection files of running kernels in the jupyter runtime directory
+connection_file = re.compile(r"^kernel-(.+)\.json$")
+
+
+class JSONFile:
+    """Parsed snapshot of a JSON file.
+
+    The snapshot is revalidated on (st_mtime_ns, st_size, st_ino), so
+    same-second rewrites and replaced files are noticed. Snapshots are
+    shared between all callers and must not be modified in place.
+    """
+
+    def __init__(self, path, description, indent):
+        self.path = path
+        self.description = description
+        self.indent = indent
+        self.name = os.path.basename(path)
+        self.file_id = None
+        self.data = {}
+
+    def identity(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def read(self, logger):
+        file_id = self.identity()
+        if file_id == self.file_id:
+            metrics.file_cache.inc(self.name, "hit")
+            return self.data
+        metrics.file_cache.inc(self.name, "miss")
+        if file_id is None:
+            data = {}
+        else:
+            try:
+                metrics.json_parses.inc(self.name)
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+            except Exception:
+                # Keep the last good snapshot, e.g. while someone else is writing the file
+                logger.exception(f"Could not read {self.description} file")
+                return self.data
+        self.file_id = file_id
+        self.data = data
+        return self.data
+
+    def write(self, data, logger):
+        """Atomically replaces the file with data. Returns False if nothing changed."""
+        if data == self.read(logger):
+            return False
+        dirname = os.path.dirname(self.path)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=f".{os.path.basename(self.path)}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps(data, indent=self.indent, sort_keys=True))
+            if os.path.exists(self.path):
+                shutil.copymode(self.path, tmp_path)
+            else:
+                os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        metrics.json_writes.inc(self.name)
+        self.file_id = self.identity()
+        self.data = data
+        return True
+
+
+class StateStore:
+    """Single owner of kernel.json, the allocations file and its archive.
+
+    All methods block on file system access and are meant to run on the
+    io executor. A lock serializes them, so writers never interleave and
+    readers never see a snapshot in the middle of an update.
+
+    Every change of the served state increases a counter. Together with a
+    random epoch per store it forms the version ("<epoch>-<counter>"), which
+    is used for ETags and to send only the allocations changed since a
+    version the client already has.
+    """
+
+    def __init__(self, kernel_file, allocations_file, archive_file):
+        self.kernel = JSONFile(kernel_file, "slurm-provisioner-kernel/kernel.json", indent=4)
+        self.allocations = JSONFile(allocations_file, "runtime/slurm_provisioner.json", indent=2)
+        self.archive = JSONFile(archive_file, "runtime/slurm_provisioner_archive.json", indent=2)
+        self.lock = threading.RLock()
+        # Slurm's view of the jobs, see SqueuePoller
+        self.jobs = None
+        self._merged = (None, None, {})
+        self.epoch = uuid.uuid4().hex[:8]
+        self.counter = 0
+        self._last = (None, None)
+        self._config_version = 0
+        self._allocation_versions = {}
+        self._removed = {}
+        self._removed_floor = 0
+        self._index = (None, {})
+        self._dead_since = {}
+
+    @property
+    def version(self):
+        return f"{self.epoch}-{self.counter}"
+
+    def _update_version(self, config, allocations):
+        last_config, last_allocations = self._last
+        if config is last_config and allocations is last_allocations:
+            return
+        counter = self.counter + 1
+        changed = False
+        if config != last_config:
+            self._config_version = counter
+            changed = True
+        if allocations is not last_allocations:
+            last_allocations = last_allocations or {}
+            for jobid, allocation in allocations.items():
+                if last_allocations.get(jobid) != allocation:
+                    self._allocation_versions[jobid] = counter
+                    self._removed.pop(jobid, None)
+                    changed = True
+            for jobid in last_allocations.keys() - allocations.keys():
+                self._allocation_versions.pop(jobid, None)
+                self._removed[jobid] = counter
+                changed = True
+            while len(self._removed) > removed_limit:
+                # oldest first, removed jobids are never re-inserted without being popped
+                self._removed_floor = self._removed.pop(next(iter(self._removed)))
+        self._last = (config, allocations)
+        if changed:
+            self.counter = counter
+
+    def _current_config(self, logger):
+        return self.kernel.read(logger).get("metadata", {}).get("kernel_provisioner", {}).get("config", {})
+
+    def _allocations(self, logger):
+        allocations = self.allocations.read(logger)
+        if self.jobs is None:
+            return allocations
+        source, jobs, merged = self._merged
+        if source is not allocations or jobs is not self.jobs:
+            merged = {
+                jobid: dict(allocation, **self.jobs[jobid]) if jobid in self.jobs else allocation
+                for jobid, allocation in allocations.items()
+            }
+            self._merged = (allocations, self.jobs, merged)
+        return merged
+
+    def get_allocations(self, logger):
+        with self.lock:
+            return self._allocations(logger)
+
+    def update_jobs(self, jobs, queried, logger):
+        """Stores the jobs reported by squeue and archives allocations of dead jobs.
+
+        Only jobids in queried (the allocations known before squeue was
+        called) are pruned.
+        """
+        with self.lock:
+            if jobs != self.jobs:
+                self.jobs = jobs
+            allocations = self.allocations.read(logger)
+            dead = [jobid for jobid in allocations.keys() if jobid in queried and jobid not in jobs]
+            if dead:
+                logger.info(f"Slurmel: Archive finished jobs {', '.join(dead)}")
+                self._archive({jobid: allocations[jobid] for jobid in dead}, logger)
+                allocations = {jobid: allocation for jobid, allocation in allocations.items() if jobid not in dead}
+                self.allocations.write(allocations, logger)
+
+    def _archive(self, archived, logger):
+        """Adds allocations to the archive file, kernel IDs of a jobid are collected across calls."""
+        archive = dict(self.archive.read(logger))
+        for jobid, allocation in archived.items():
+            kernel_ids = archive.get(jobid, {}).get("kernel_ids", []) + allocation.get("kernel_ids", [])
+            archive[jobid] = dict(allocation, kernel_ids=kernel_ids)
+        self.archive.write(archive, logger)
+
+    def set_current_config(self, config, logger):
+        with self.lock:
+            kernel_json = copy.deepcopy(self.kernel.read(logger))
+            kernel_json.setdefault("metadata", {}).setdefault("kernel_provisioner", {})["config"] = config
+            return self.kernel.write(kernel_json, logger)
+
+    def remove_allocations(self, jobids, logger):
+        with self.lock:
+            allocations = self.allocations.read(logger)
+            if not any(jobid in allocations.keys() for jobid in jobids):
+                return False
+            allocations = {jobid: allocation for jobid, allocation in allocations.items() if jobid not in jobids}
+            return self.allocations.write(allocations, logger)
+
+    def sanitize(self, logger):
+        """Resets the selected allocation in kernel.json, if it's no longer available."""
+        with self.lock:
+            config = self._current_config(logger)
+            now = datetime.now().timestamp()
+            current_jobid = config.get("jobid", "None")
+
+            # a job must be selected
+            if current_jobid == "None":
+                return
+            allocations = self._allocations(logger)
+            endtime = allocations.get(current_jobid, {}).get("endtime", now)
+            # an endtime must be set (if it's null/None, it's not started yet)
+            if not endtime:
+                return
+            # selected job, which has been run in the past, is not in allocations or finished
+            if current_jobid not in allocations.keys() or endtime < now:
+                config = dict(config)
+                config["jobid"] = "None"
+                config["node"] = "None"
+                metrics.config_resets.inc()
+                self.set_current_config(config, logger)
+
+    def snapshot(self, logger):
+        """Returns the sanitized current config and allocations and their version."""
+        with self.lock:
+            self.sanitize(logger)
+            config = self._current_config(logger)
+            allocations = self._allocations(logger)
+            self._update_version(config, allocations)
+            return {
+                "version": self.version,
+                "current_config": config,
+                "allocations": allocations
+            }
+
+    def changes_since(self, since, logger):
+        """Like snapshot, but only with the parts changed after version since.
+
+        Allocations removed since then are listed in "removed". If since
+        is unknown (e.g. from before a server restart) or older than the
+        last removed_limit removals, the full snapshot is returned.
+        """
+        with self.lock:
+            state = self.snapshot(logger)
+            epoch, _, counter = since.partition("-")
+            if (epoch != self.epoch or not counter.isdigit() or int(counter) > self.counter
+                    or int(counter) < self._removed_floor):
+                return state
+            counter = int(counter)
+            changes = {
+                "version": state["version"],
+                "since": since,
+                "allocations": {
+                    jobid: allocation for jobid, allocation in state["allocations"].items()
+                    if self._allocation_versions.get(jobid, 0) > counter
+                },
+                "removed": [jobid for jobid, version in self._removed.items() if version > counter]
+            }
+            if self._config_version > counter:
+                changes["current_config"] = state["current_config"]
+            return changes
+
+    def _kernel_index(self, allocations):
+        source, index = self._index
+        if source is not allocations:
+            index = {}
+            for jobid, allocation in allocations.items():
+                for kernel_id in allocation.get("kernel_ids", []):
+                    index.setdefault(kernel_id, jobid)
+            self._index = (allocations, index)
+        return index
+
+    def find_kernel(self, kernel_id, logger):
+        """Returns the version and (jobid, allocation) of the kernel or None."""
+        with self.lock:
+            state = self.snapshot(logger)
+            jobid = self._kernel_index(state["allocations"]).get(kernel_id, None)
+            if jobid is None:
+                return state["version"], None
+            return state["version"], (jobid, state["allocations"][jobid])
+
+    def compact(self, retention, logger):
+        """Moves expired allocations and dead kernel IDs to the archive file.
+
+        Allocations are archived once their endtime is more than retention
+        seconds ago. A kernel ID is dead if its connection file is missing
+        in the jupyter runtime directory (shared by all servers of the user).
+        It is archived after being dead for retention seconds. If the runtime
+        directory can't be listed, kernel IDs are left alone.
+        """
+        with self.lock:
+            now = time.time()
+            try:
+                filenames = os.listdir(jupyter_runtime_dir())
+            except OSError:
+                logger.warning("Slurmel: Could not list the runtime directory, dead kernels are kept")
+                running = None
+            else:
+                running = {match.group(1) for match in map(connection_file.match, filenames) if match}
+            allocations = self.allocations.read(logger)
+            # endtimes reported by squeue win over the ones in the file
+            merged = self._allocations(logger)
+            compacted = {}
+            archived = {}
+            dead_since = {}
+            for jobid, allocation in allocations.items():
+                endtime = merged.get(jobid, allocation).get("endtime", None)
+                if endtime and endtime < now - retention:
+                    archived[jobid] = allocation
+                    continue
+                if running is None:
+                    compacted[jobid] = allocation
+                    continue
+                alive, dead = [], []
+                for kernel_id in allocation.get("kernel_ids", []):
+                    if kernel_id not in running:
+                        dead_since[kernel_id] = self._dead_since.get(kernel_id, now)
+                        if dead_since[kernel_id] < now - retention:
+                            dead.append(kernel_id)
+                            continue
+                    alive.append(kernel_id)
+                if dead:
+                    archived[jobid] = dict(allocation, kernel_ids=dead)
+                    allocation = dict(allocation, kernel_ids=alive)
+                compacted[jobid] = allocation
+            if running is not None:
+                self._dead_since = dead_since
+            if not archived:
+                return False
+
+            self._archive(archived, logger)
+            logger.info(f"Slurmel: Archived {len(archived)} allocations or their dead kernels")
+            return self.allocations.write(compacted, logger)
@@ -2,19 +2,21 @@ import { URLExt } from '@jupyterlab/coreutils';
 
 import { ServerConnection } from '@jupyterlab/services';
 
+import { ISignal, Signal } from '@lumino/signaling';
+
 import { OptionsForm } from './widgets';
 
 /**
- * Call the API extension
+ * Send a request to the API extension
  *
  * @param endPoint API REST end point for the extension
  * @param init Initial values for the request
- * @returns The response body interpreted as JSON
+ * @returns The response
  */
-export async function requestAPI<T>(
+async function fetchAPI(
   endPoint = '',
   init: RequestInit = {}
-): Promise<T> {
+): Promise<Response> {
   // Make request to Jupyter API
   const settings = ServerConnection.makeSettings();
   const requestUrl = URLExt.join(
@@ -23,12 +25,25 @@ export async function requestAPI<T>(
     endPoint
   );
 
-  let response: Response;
   try {
-    response = await ServerConnection.makeRequest(requestUrl, init, settings);
+    return await ServerConnection.makeRequest(requestUrl, init, settings);
   } catch (error) {
     throw new ServerConnection.NetworkError(error as any);
   }
+}
+
+/**
+ * Call the API extension
+ *
+ * @param endPoint API REST end point for the extension
+ * @param init Initial values for the request
+ * @returns The response body interpreted as JSON
+ */
+export async function requestAPI<T>(
+  endPoint = '',
+  init: RequestInit = {}
+): Promise<T> {
+  const response = await fetchAPI(endPoint, init);
 
   let data: any = await response.text();
 
@@ -71,6 +86,11 @@ export async function sendPostRequest(config: any) {
   });
 }
 
+/**
+ * Last response per path, used for conditional requests
+ */
+const responseCache: { [path: string]: { etag: string; data: any } } = {};
+
 export async function sendGetRequest(path: string): Promise<OptionsForm> {
   let config_system: OptionsForm = {
     dropdown_lists: {},
@@ -79,15 +99,36 @@ export async function sendGetRequest(path: string): Promise<OptionsForm> {
     documentationhref: '',
     current_config: {}
   };
-  await requestAPI<any>(path)
-    .then(data => {
+  // Revalidate the response we already have, so unchanged
+  // responses cost a 304 without a body.
+  const cached = responseCache[path];
+  const init: RequestInit = { cache: 'no-store' };
+  if (cached) {
+    init.headers = { 'If-None-Match': cached.etag };
+  }
+  try {
+    const response = await fetchAPI(path, init);
+    if (response.status === 304 && cached) {
+      config_system = cached.data;
+    } else {
+      const data = await response.json();
+      if (!response.ok) {
+        throw new ServerConnection.ResponseError(
+          response,
+          data.message || data
+        );
+      }
       config_system = data;
-    })
-    .catch(reason => {
-      console.error(
-        `Slurm-Configurator: Could not receive OptionsForm for user.\n${reason}`
-      );
-    });
+      const etag = response.headers.get('Etag');
+      if (etag) {
+        responseCache[path] = { etag, data: config_system };
+      }
+    }
+  } catch (reason) {
+    console.error(
+      `Slurm-Configurator: Could not receive OptionsForm for user.\n${reason}`
+    );
+  }
   return config_system;
 }
 
@@ -99,3 +140,135 @@ export async function sendCancelRequest(jobid: string) {
     alert('Could not stop Allocation with jobid ' + jobid);
   });
 }
+
+/**
+ * Cancel multiple allocations with one request
+ *
+ * @param jobids Job IDs of the allocations
+ */
+export async function sendCancelRequests(jobids: Array<string>) {
+  await requestAPI<any>('scancel', {
+    body: JSON.stringify({ jobids: jobids }),
+    method: 'POST'
+  })
+    .then(data => {
+      const failed = jobids.filter(jobid => !data.results[jobid].success);
+      if (failed.length > 0) {
+        alert('Could not stop Allocations with jobids ' + failed.join(', '));
+      }
+    })
+    .catch(reason => {
+      alert('Could not stop Allocations with jobids ' + jobids.join(', '));
+    });
+}
+
+/**
+ * Allocation of a kernel, as returned by slurm-provisioner/kernel/<id>
+ */
+export interface IKernelAllocation {
+  jobid: string;
+  endtime: number | null;
+  state: string | null;
+  nodelist: Array<string>;
+}
+
+/**
+ * Look up the allocation a kernel runs in
+ *
+ * @param kernelId ID of the kernel
+ * @returns The allocation or null, if the kernel is not in any allocation
+ */
+export async function sendKernelRequest(
+  kernelId: string
+): Promise<IKernelAllocation | null> {
+  return await requestAPI<IKernelAllocation>(
+    'kernel/' + encodeURIComponent(kernelId)
+  ).catch(reason => {
+    if (!(reason instanceof ServerConnection.ResponseError)) {
+      console.log('Could not look up the allocation of kernel ' + kernelId);
+    }
+    return null;
+  });
+}
+
+/**
+ * Local state pushed by the server via the slurm-provisioner/stream websocket.
+ * One connection is shared by the side panel and all notebook toolbars.
+ */
+export class StateStream {
+  private _state: { [key: string]: any } = {
+    current_config: {},
+    allocations: {}
+  };
+  private _changed = new Signal<StateStream, OptionsForm>(this);
+  private _socket: WebSocket | null = null;
+  private _reconnectDelay = 1000;
+
+  constructor() {
+    this._connect();
+  }
+
+  /**
+   * Current state, updated with every message of the server
+   */
+  get state(): OptionsForm {
+    return {
+      dropdown_lists: {},
+      resources: {},
+      documentationhref: '',
+      current_config: this._state.current_config,
+      allocations: this._state.allocations
+    };
+  }
+
+  public get changed(): ISignal<StateStream, OptionsForm> {
+    return this._changed;
+  }
+
+  private _connect() {
+    const settings = ServerConnection.makeSettings();
+    let url = URLExt.join(settings.wsUrl, 'slurm-provisioner', 'stream');
+    if (settings.token && settings.appendToken) {
+      url = url + `?token=${encodeURIComponent(settings.token)}`;
+    }
+    this._socket = new settings.WebSocket(url);
+    this._socket.onopen = () => {
+      this._reconnectDelay = 1000;
+    };
+    this._socket.onmessage = (evt: MessageEvent) => {
+      // The server sends the full state after connecting and afterwards
+      // only the allocations which changed or were removed since then
+      const data = JSON.parse(evt.data);
+      if (data.since === undefined) {
+        this._state = data;
+      } else {
+        const allocations = { ...this._state.allocations, ...data.allocations };
+        for (const jobid of data.removed) {
+          delete allocations[jobid];
+        }
+        this._state = {
+          current_config: data.current_config || this._state.current_config,
+          allocations
+        };
+      }
+      this._changed.emit(this.state);
+    };
+    this._socket.onclose = () => {
+      this._socket = null;
+      setTimeout(() => this._connect(), this._reconnectDelay);
+      this._reconnectDelay = Math.min(this._reconnectDelay * 2, 30000);
+    };
+  }
+}
+
+let stateStream: StateStream | null = null;
+
+/**
+ * Returns the shared StateStream, connecting it on first use
+ */
+export function getStateStream(): StateStream {
+  if (!stateStream) {
+    stateStream = new StateStream();
+  }
+  return stateStream;
+}
@@ -2,14 +2,14 @@ import { IDisposable, DisposableDelegate } from '@lumino/disposable';
 
 import { DocumentRegistry } from '@jupyterlab/docregistry';
 
-import { sendGetRequest } from './handler';
+import { getStateStream, sendKernelRequest, StateStream } from './handler';
 
 import { NotebookPanel, INotebookModel } from '@jupyterlab/notebook';
 
 import * as React from 'react';
 import * as apputils from '@jupyterlab/apputils';
 
-import { AllocationTimer } from './widgets';
+import { AllocationTimer, OptionsForm } from './widgets';
 
 export class ToolbarCountdown
   implements DocumentRegistry.IWidgetExtension<NotebookPanel, INotebookModel>
@@ -54,15 +54,21 @@ class RemainingTimeComp extends React.Component<
     date_endtime: any;
     date_label: string;
     kernel_id: string;
+    jobid: string;
+    slurm_connected: boolean;
   }
 > {
+  private _knownJobids = new Set<string>();
+
   constructor(props: any) {
     super(props);
     this.state = {
       date_show: false,
       date_endtime: 0,
       date_label: 'Remaining time: ',
-      kernel_id: ''
+      kernel_id: '',
+      jobid: '',
+      slurm_connected: false
     };
     this.props.panel.sessionContext.kernelChanged.connect(
       this._kernelChanged,
@@ -72,6 +78,11 @@ class RemainingTimeComp extends React.Component<
       this._connectionStatusChanged,
       this
     );
+    getStateStream().changed.connect(this._streamChanged, this);
+  }
+
+  componentWillUnmount() {
+    getStateStream().changed.disconnect(this._streamChanged, this);
   }
 
   async _kernelChanged(a: any, b: any) {
@@ -82,31 +93,53 @@ class RemainingTimeComp extends React.Component<
   }
 
   async _connectionStatusChanged(a: any, b: any) {
-    let found_kernel = false;
-    if (a._prevKernelName === 'slurm-provisioner-kernel' && b === 'connected') {
-      const kernelID = this.state.kernel_id;
-      const config_system = await sendGetRequest('local');
-      for (const x in config_system.allocations) {
-        if (
-          !found_kernel &&
-          config_system.allocations[x].kernel_ids.includes(kernelID)
-        ) {
-          this.setState({
-            date_endtime: config_system.allocations[x].endtime,
-            date_show: true,
-            date_label: 'Remaining time ( allocation ' + String(x) + ' ): '
-          });
-          found_kernel = true;
-        }
-      }
-      /**
-       * Request - get current slurm_provisioner.json
-       * Run through all allocations, find kernel_id in list
-       * If there -> show allocID + endtime (tickDown)
-       * If not there -> show nothing
-       */
+    const slurm_connected =
+      a._prevKernelName === 'slurm-provisioner-kernel' && b === 'connected';
+    this.setState({ slurm_connected });
+    if (slurm_connected) {
+      await this._showAllocation();
+    } else {
+      this.setState({ jobid: '', date_show: false });
+    }
+  }
+
+  private _streamChanged(emitter: StateStream, data: OptionsForm): void {
+    const jobids = Object.keys(data.allocations);
+    const added = jobids.some(jobid => !this._knownJobids.has(jobid));
+    this._knownJobids = new Set(jobids);
+    if (!this.state.slurm_connected) {
+      return;
+    }
+    const allocation = data.allocations[this.state.jobid];
+    if (allocation) {
+      this.setState({ date_endtime: allocation.endtime });
+    } else if (this.state.jobid) {
+      // allocation is gone
+      this.setState({ jobid: '', date_show: false });
+    } else if (added) {
+      // the kernel was not found before, it may be in the new allocation
+      this._showAllocation();
+    }
+  }
+
+  /**
+   * Ask the server which allocation runs the kernel
+   * If there -> show allocID + endtime (tickDown)
+   * If not there -> show nothing
+   */
+  private async _showAllocation() {
+    const allocation = await sendKernelRequest(this.state.kernel_id);
+    if (allocation) {
+      this.setState({
+        jobid: allocation.jobid,
+        date_endtime: allocation.endtime,
+        date_show: true,
+        date_label:
+          'Remaining time ( allocation ' + String(allocation.jobid) + ' ): '
+      });
+    } else {
+      this.setState({ jobid: '', date_show: false });
     }
-    this.setState({ date_show: found_kernel });
   }
 
   render() {
@@ -1,10 +1,16 @@
 import * as React from 'react';
-import { ReactWidget } from '@jupyterlab/apputils';
+import { Dialog, ReactWidget, showDialog } from '@jupyterlab/apputils';
 import { CommandRegistry } from '@lumino/commands';
 import { Message } from '@lumino/messaging';
 import { ISignal, Signal } from '@lumino/signaling';
 
-import { sendCancelRequest, sendGetRequest } from './handler';
+import {
+  getStateStream,
+  sendCancelRequest,
+  sendCancelRequests,
+  sendGetRequest,
+  StateStream
+} from './handler';
 import { slurmelIcon } from './icon';
 
 import Collapsible from 'react-collapsible';
@@ -117,28 +123,11 @@ export class SlurmPanel extends ReactWidget {
     this._available_kernels = available_kernels;
     this._commands = commands;
 
-    this.updateInfos();
+    getStateStream().changed.connect(this._streamChanged, this);
   }
 
-  async delay(ms: number) {
-    return await new Promise(resolve => setTimeout(resolve, ms));
-  }
-
-  async updateInfos() {
-    // Poll for file changes
-    // do not poll if panel is not visible
-
-    // eslint-disable-next-line no-constant-condition
-    while (true) {
-      if (this.isVisible) {
-        const data = await sendGetRequest('local');
-        this._stateChanged.emit(data);
-        await this.delay(2000);
-      } else {
-        // shorter delay if not visible
-        await this.delay(500);
-      }
-    }
+  private _streamChanged(emitter: StateStream, data: OptionsForm): void {
+    this._stateChanged.emit(data);
   }
 
   public get stateChanged(): ISignal<SlurmPanel, OptionsForm> {
@@ -213,6 +202,21 @@ export class KernelInfos extends React.Component<
     sendCancelRequest(jobid);
   }
 
+  async cancelAllAllocations() {
+    const jobids = this.state.allocation_infos.map(info => info.id);
+    const result = await showDialog({
+      title: 'Kill all allocations',
+      body: `This cancels the Slurm jobs ${jobids.join(', ')}.`,
+      buttons: [
+        Dialog.cancelButton({ label: 'Cancel' }),
+        Dialog.warnButton({ label: 'Kill all' })
+      ]
+    });
+    if (result.button.accept) {
+      sendCancelRequests(jobids);
+    }
+  }
+
   render() {
     // Nothing configured yet.
     if (this.state.empty) {
@@ -239,6 +243,17 @@ export class KernelInfos extends React.Component<
         </div>
       );
     }
+    if (this.state.allocation_infos.length > 1) {
+      content.push(
+        <button
+          className={btnClass}
+          style={{ width: '100%' }}
+          onClick={() => this.cancelAllAllocations()}
+        >
+          Kill all
+        </button>
+      );
+    }
     // Return current configuration.
     return <React.Fragment>{content}</React.Fragment>;
   }
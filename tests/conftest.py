@@ -0,0 +1,100 @@
+import json
+import os
+import time
+
+import pytest
+
+from jupyter_slurm_provisioner_extension import _unload_jupyter_server_extension
+from jupyter_slurm_provisioner_extension import handlers
+
+pytest_plugins = ("pytest_jupyter.jupyter_server",)
+
+
+def allocation(jobid, kernel_ids=(), endtime=None, state="RUNNING"):
+    return {
+        "config": {"jobid": jobid, "partition": "batch", "project": "test"},
+        "endtime": time.time() + 3600 if endtime is None else endtime,
+        "kernel_ids": list(kernel_ids),
+        "nodelist": ["node001"],
+        "state": state
+    }
+
+
+class SlurmelFiles:
+    """kernel.json, the allocations file and the archive in a temporary directory."""
+
+    def __init__(self, path):
+        self.kernel_file = str(path / "kernels" / "slurm-provisioner-kernel" / "kernel.json")
+        self.allocations_file = str(path / "runtime" / "slurm_provisioner.json")
+        self.archive_file = str(path / "runtime" / "slurm_provisioner_archive.json")
+        os.makedirs(os.path.dirname(self.kernel_file))
+        os.makedirs(os.path.dirname(self.allocations_file))
+        with open(self.kernel_file, "w") as f:
+            json.dump(handlers.default_kernel(), f)
+
+    def write_allocations(self, allocations):
+        with open(self.allocations_file, "w") as f:
+            json.dump(allocations, f)
+
+    def read_allocations(self):
+        with open(self.allocations_file) as f:
+            return json.load(f)
+
+    def read_archive(self):
+        with open(self.archive_file) as f:
+            return json.load(f)
+
+
+@pytest.fixture
+def slurmel_files(tmp_path, monkeypatch):
+    files = SlurmelFiles(tmp_path / "slurmel")
+    monkeypatch.setattr(handlers, "current_config_file", files.kernel_file)
+    monkeypatch.setattr(handlers, "allocations_file", files.allocations_file)
+    monkeypatch.setattr(handlers, "archive_file", files.archive_file)
+    return files
+
+
+@pytest.fixture
+def fake_bin(tmp_path, monkeypatch):
+    """Returns a function creating executables in a directory on PATH.
+
+    Every script appends its arguments to <name>.calls, one line per call.
+    """
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ.get('PATH', '')}")
+
+    def create(name, body):
+        script = bindir / name
+        script.write_text(f'#!/bin/sh\necho "$@" >> "{bindir / name}.calls"\n{body}\n')
+        script.chmod(0o755)
+        return bindir / f"{name}.calls"
+
+    return create
+
+
+def read_calls(calls_file):
+    if not calls_file.exists():
+        return []
+    return [line.split() for line in calls_file.read_text().splitlines()]
+
+
+@pytest.fixture
+def jp_server_config(slurmel_files):
+    return {"ServerApp": {"jpserver_extensions": {"jupyter_slurm_provisioner_extension": True}}}
+
+
+@pytest.fixture
+def jp_serverapp(jp_serverapp):
+    yield jp_serverapp
+    # jupyter_server itself only stops extension apps
+    _unload_jupyter_server_extension(jp_serverapp)
+
+
+def find_handler_kwargs(web_app, handler_class):
+    """Returns the initialize kwargs of a registered handler."""
+    for host_rule in web_app.default_router.rules:
+        for rule in getattr(host_rule.target, "rules", []):
+            if rule.target is handler_class:
+                return rule.target_kwargs
+    raise LookupError(handler_class)
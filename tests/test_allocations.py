@@ -0,0 +1,91 @@
+import json
+import logging
+import time
+
+import pytest
+
+from tornado.httpclient import HTTPClientError
+
+from conftest import allocation
+from jupyter_slurm_provisioner_extension.store import StateStore
+
+logger = logging.getLogger("test")
+
+
+def store_for(files):
+    return StateStore(files.kernel_file, files.allocations_file, files.archive_file)
+
+
+async def test_kernel_lookup(jp_fetch, slurmel_files):
+    slurmel_files.write_allocations({"1": allocation("1", ["k1", "k2"]), "2": allocation("2", ["k3"])})
+    response = await jp_fetch("slurm-provisioner", "kernel", "k3")
+    body = json.loads(response.body)
+    assert body["jobid"] == "2"
+    assert body["state"] == "RUNNING"
+    assert body["nodelist"] == ["node001"]
+
+    response = await jp_fetch("slurm-provisioner", "kernel", "k3", headers={"If-None-Match": response.headers["Etag"]},
+                              raise_error=False)
+    assert response.code == 304
+
+    with pytest.raises(HTTPClientError) as e:
+        await jp_fetch("slurm-provisioner", "kernel", "unknown")
+    assert e.value.code == 404
+
+
+def test_pruned_jobs_are_archived(slurmel_files):
+    allocations = {"1": allocation("1", ["k1"]), "2": allocation("2", ["k2"])}
+    slurmel_files.write_allocations(allocations)
+    store = store_for(slurmel_files)
+    store.update_jobs({"1": {"state": "RUNNING", "nodelist": [], "endtime": None}}, {"1", "2"}, logger)
+    assert list(slurmel_files.read_allocations()) == ["1"]
+    assert slurmel_files.read_archive() == {"2": allocations["2"]}
+
+
+def test_compact(slurmel_files, tmp_path, monkeypatch):
+    runtime = tmp_path / "runtime"
+    runtime.mkdir()
+    monkeypatch.setenv("JUPYTER_RUNTIME_DIR", str(runtime))
+    now = time.time()
+    slurmel_files.write_allocations({
+        "1": allocation("1", ["k1"], endtime=now - 2 * 86400),
+        "2": allocation("2", ["running", "dead"], endtime=now + 3600),
+        # not started yet
+        "3": dict(allocation("3", ["pending"], state="PENDING"), endtime=None)
+    })
+    (runtime / "kernel-running.json").touch()
+    store = store_for(slurmel_files)
+
+    # expired allocations are archived at once, dead kernels only after the retention
+    assert store.compact(86400, logger)
+    assert sorted(slurmel_files.read_allocations()) == ["2", "3"]
+    assert slurmel_files.read_allocations()["2"]["kernel_ids"] == ["running", "dead"]
+    assert slurmel_files.read_archive()["1"]["kernel_ids"] == ["k1"]
+    assert not store.compact(86400, logger)
+
+    store._dead_since = {kernel_id: since - 86401 for kernel_id, since in store._dead_since.items()}
+    assert store.compact(86400, logger)
+    allocations = slurmel_files.read_allocations()
+    assert allocations["2"]["kernel_ids"] == ["running"]
+    assert allocations["3"]["kernel_ids"] == []
+    archive = slurmel_files.read_archive()
+    assert archive["2"]["kernel_ids"] == ["dead"]
+    assert archive["3"]["kernel_ids"] == ["pending"]
+
+
+def test_compact_without_runtime_dir(slurmel_files, tmp_path, monkeypatch):
+    monkeypatch.setenv("JUPYTER_RUNTIME_DIR", str(tmp_path / "missing"))
+    now = time.time()
+    allocations = {
+        "1": allocation("1", ["k1"], endtime=now - 2 * 86400),
+        "2": allocation("2", ["k2"], endtime=now + 3600)
+    }
+    slurmel_files.write_allocations(allocations)
+    store = store_for(slurmel_files)
+    store._dead_since = {"k2": now - 2 * 86400}
+
+    # expired allocations are still archived, but no kernel counts as dead
+    assert store.compact(86400, logger)
+    assert slurmel_files.read_allocations() == {"2": allocations["2"]}
+    assert slurmel_files.read_archive() == {"1": allocations["1"]}
+    assert store._dead_since == {"k2": now - 2 * 86400}
@@ -0,0 +1,61 @@
+import json
+
+from conftest import allocation
+
+
+async def scrape(jp_fetch):
+    """Returns the samples of /slurm-provisioner/metrics by name and labels."""
+    response = await jp_fetch("slurm-provisioner", "metrics")
+    assert response.headers["Content-Type"].startswith("text/plain")
+    samples = {}
+    for line in response.body.decode().splitlines():
+        if line and not line.startswith("#"):
+            sample, value = line.rsplit(" ", 1)
+            samples[sample] = float(value)
+    return samples
+
+
+def delta(before, after, sample):
+    return after.get(sample, 0) - before.get(sample, 0)
+
+
+async def fetch(jp_fetch, *parts, **kwargs):
+    return await jp_fetch("slurm-provisioner", *parts, raise_error=False, **kwargs)
+
+
+async def test_requests_are_counted(jp_fetch, slurmel_files):
+    slurmel_files.write_allocations({"1": allocation("1", ["k1"])})
+    before = await scrape(jp_fetch)
+
+    ok = await fetch(jp_fetch, "local")
+    not_modified = await fetch(jp_fetch, "local", headers={"If-None-Match": ok.headers["Etag"]})
+    not_found = await fetch(jp_fetch, "kernel", "unknown")
+    assert (ok.code, not_modified.code, not_found.code) == (200, 304, 404)
+    for response in [ok, not_modified, not_found]:
+        assert "total;dur=" in response.headers["Server-Timing"]
+    assert "io;dur=" in ok.headers["Server-Timing"]
+
+    after = await scrape(jp_fetch)
+    assert delta(before, after, 'slurmel_requests_total{route="local",status="200"}') == 1
+    assert delta(before, after, 'slurmel_requests_total{route="local",status="304"}') == 1
+    assert delta(before, after, 'slurmel_requests_total{route="kernel",status="404"}') == 1
+    assert delta(before, after, 'slurmel_request_duration_seconds_count{route="local"}') == 2
+    assert delta(before, after, 'slurmel_request_duration_seconds_bucket{route="local",le="+Inf"}') == 2
+    assert delta(before, after, 'slurmel_request_duration_seconds_sum{route="local"}') > 0
+    assert delta(before, after, 'slurmel_file_cache_total{file="slurm_provisioner.json",result="hit"}') >= 1
+
+
+async def test_unsupported_method(jp_fetch, slurmel_files):
+    before = await scrape(jp_fetch)
+    response = await fetch(jp_fetch, "local", method="PROPFIND", allow_nonstandard_methods=True)
+    assert response.code == 405
+    assert "Server-Timing" not in response.headers
+    after = await scrape(jp_fetch)
+    assert delta(before, after, 'slurmel_requests_total{route="local",status="405"}') == 1
+
+
+async def test_error_response_has_timing(jp_fetch, slurmel_files, fake_bin):
+    fake_bin("scancel", "exit 0")
+    response = await fetch(jp_fetch, "scancel", method="POST", body=json.dumps({"jobids": "1"}))
+    assert response.code == 400
+    assert "total;dur=" in response.headers["Server-Timing"]
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+
+import pytest
+
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from jupyter_slurm_provisioner_extension.handlers import OptionsFormCache
+
+logger = logging.getLogger("test")
+
+
+class StubHub:
+    """JupyterHub options form endpoint counting its requests."""
+
+    def __init__(self):
+        self.requests = []
+        self.latency = 0.1
+        self.status = 200
+        self.version = 1
+        self.url = None
+
+    @property
+    def body(self):
+        return {"dropdown_lists": {"projects": [f"project{self.version}"]}, "resources": {}}
+
+
+class OptionsFormHandler(web.RequestHandler):
+    def initialize(self, hub):
+        self.hub = hub
+
+    async def get(self):
+        self.hub.requests.append(self.request.headers.get("If-None-Match", None))
+        await asyncio.sleep(self.hub.latency)
+        if self.hub.status != 200:
+            raise web.HTTPError(self.hub.status)
+        self.set_header("Etag", f'"{self.hub.version}"')
+        if self.request.headers.get("If-None-Match", None) == f'"{self.hub.version}"':
+            self.set_status(304)
+            self.finish()
+            return
+        self.finish(self.hub.body)
+
+
+@pytest.fixture
+def stub_hub(io_loop):
+    hub = StubHub()
+    sock, port = bind_unused_port()
+    server = HTTPServer(web.Application([(r"/optionsform", OptionsFormHandler, {"hub": hub})]))
+    server.add_sockets([sock])
+    hub.url = f"http://127.0.0.1:{port}/optionsform"
+    yield hub
+    server.stop()
+
+
+async def test_concurrent_first_requests(stub_hub):
+    cache = OptionsFormCache(ttl=60, retry_interval=5)
+    results = await asyncio.gather(*[cache.get(stub_hub.url, {}, logger) for _ in range(20)])
+    assert len(stub_hub.requests) == 1
+    assert all(result == (stub_hub.body, 1) for result in results)
+
+    # fresh entries are served without asking the hub
+    assert await cache.get(stub_hub.url, {}, logger) == (stub_hub.body, 1)
+    assert len(stub_hub.requests) == 1
+
+
+async def test_stale_while_revalidate(stub_hub):
+    cache = OptionsFormCache(ttl=0.2, retry_interval=5)
+    old_body = stub_hub.body
+    await cache.get(stub_hub.url, {}, logger)
+    stub_hub.version = 2
+    await asyncio.sleep(0.3)
+
+    # stale copy is returned at once while one request revalidates it
+    results = await asyncio.gather(*[cache.get(stub_hub.url, {}, logger) for _ in range(10)])
+    assert all(result == (old_body, 1) for result in results)
+    await asyncio.sleep(0.2)
+    assert len(stub_hub.requests) == 2
+    assert await cache.get(stub_hub.url, {}, logger) == (stub_hub.body, 2)
+
+
+async def test_revalidation_with_etag(stub_hub):
+    cache = OptionsFormCache(ttl=0, retry_interval=5)
+    body, version = await cache.get(stub_hub.url, {}, logger)
+    await cache.get(stub_hub.url, {}, logger)
+    await asyncio.sleep(0.2)
+    assert stub_hub.requests == [None, '"1"']
+    # 304: same body and version
+    assert await cache.get(stub_hub.url, {}, logger) == (body, version)
+
+
+async def test_hub_errors_keep_last_good_copy_and_back_off(stub_hub):
+    cache = OptionsFormCache(ttl=1, retry_interval=0.5)
+    body, version = await cache.get(stub_hub.url, {}, logger)
+    stub_hub.status = 503
+    await asyncio.sleep(1.1)
+
+    assert await cache.get(stub_hub.url, {}, logger) == (body, version)
+    await asyncio.sleep(0.2)
+    assert len(stub_hub.requests) == 2
+    first_retry_at = cache.entries[stub_hub.url]["retry_at"]
+
+    # within the retry interval the failing hub is not asked again
+    for _ in range(10):
+        assert await cache.get(stub_hub.url, {}, logger) == (body, version)
+    await asyncio.sleep(0.05)
+    assert len(stub_hub.requests) == 2
+
+    await asyncio.sleep(0.5)
+    assert await cache.get(stub_hub.url, {}, logger) == (body, version)
+    await asyncio.sleep(0.2)
+    assert len(stub_hub.requests) == 3
+    # the interval is doubled after the second failure, up to the ttl
+    entry = cache.entries[stub_hub.url]
+    assert entry["failures"] == 2
+    assert entry["retry_at"] - first_retry_at >= 1
+
+    stub_hub.status = 200
+    stub_hub.version = 2
+    await asyncio.sleep(1.1)
+    await cache.get(stub_hub.url, {}, logger)
+    await asyncio.sleep(0.2)
+    assert await cache.get(stub_hub.url, {}, logger) == (stub_hub.body, 2)
+    assert entry["failures"] == 0
+
+
+async def test_first_request_fails(stub_hub):
+    cache = OptionsFormCache(ttl=60, retry_interval=60)
+    stub_hub.status = 500
+    assert await cache.get(stub_hub.url, {}, logger) == ({}, 0)
+    assert await cache.get(stub_hub.url, {}, logger) == ({}, 0)
+    assert len(stub_hub.requests) == 1
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from tornado.httpclient import HTTPClientError
+
+from conftest import allocation
+from conftest import read_calls
+from jupyter_slurm_provisioner_extension import execution
+from jupyter_slurm_provisioner_extension import metrics
+
+# Rejects job 13 like a job of another user and does not know job 14
+fake_scancel = """\
+for jobid in "$@"; do
+    case "$jobid" in
+        13) echo "scancel: error: Kill job error on job id 13: Access/permission denied" >&2; failed=1;;
+        14) echo "scancel: error: Kill job error on job id 14: Invalid job id specified" >&2; failed=1;;
+    esac
+done
+exit ${failed:-0}"""
+
+
+@pytest.fixture(autouse=True)
+def batch_size(monkeypatch):
+    # read by setup_handlers, so it must be set before jp_serverapp
+    monkeypatch.setenv("SLURMEL_SCANCEL_BATCH_SIZE", "2")
+
+
+def allocation_writes():
+    return metrics.json_writes.values.get(("slurm_provisioner.json",), 0)
+
+
+async def post_scancel(jp_fetch, body):
+    return await jp_fetch("slurm-provisioner", "scancel", method="POST", body=body)
+
+
+async def probe(jp_fetch, until):
+    """Requests /api until the future until is done, returns the latencies."""
+    latencies = []
+    while not until.done():
+        start = time.perf_counter()
+        await jp_fetch("api")
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(0.05)
+    return latencies
+
+
+async def test_slow_scancel_does_not_block(jp_fetch, slurmel_files, fake_bin):
+    calls = fake_bin("scancel", "sleep 1")
+    slurmel_files.write_allocations({"1": allocation("1")})
+    cancel = asyncio.ensure_future(
+        jp_fetch("slurm-provisioner", "scancel", method="POST", body=json.dumps({"jobid": "1"})))
+    latencies = await probe(jp_fetch, cancel)
+    assert (await cancel).code == 200
+    assert read_calls(calls) == [["1"]]
+    # the server kept answering while scancel was running
+    assert len(latencies) > 5
+    assert max(latencies) < 0.5
+
+
+async def test_scancel_timeout(jp_fetch, slurmel_files, fake_bin, monkeypatch):
+    monkeypatch.setattr(execution, "command_timeout", 0.5)
+    fake_bin("scancel", "sleep 5")
+    slurmel_files.write_allocations({"1": allocation("1")})
+    start = time.perf_counter()
+    with pytest.raises(HTTPClientError) as e:
+        await jp_fetch("slurm-provisioner", "scancel", method="POST", body=json.dumps({"jobid": "1"}))
+    assert e.value.code == 500
+    assert time.perf_counter() - start < 3
+
+
+async def test_cancel_many_jobs(jp_fetch, slurmel_files, fake_bin):
+    calls = fake_bin("scancel", fake_scancel)
+    slurmel_files.write_allocations({jobid: allocation(jobid) for jobid in ["11", "12", "13", "14", "15", "16"]})
+    writes = allocation_writes()
+
+    response = await post_scancel(jp_fetch, json.dumps({"jobids": ["11", "12", "13", "14", "15", "11"]}))
+    results = json.loads(response.body)["results"]
+
+    # one scancel per batch of two, duplicates are dropped
+    assert sorted(read_calls(calls)) == [["11", "12"], ["13", "14"], ["15"]]
+    assert allocation_writes() == writes + 1
+    assert {jobid: result["success"] for jobid, result in results.items()} == {
+        "11": True, "12": True, "13": False, "14": False, "15": True
+    }
+    assert results["13"]["message"] == "Access/permission denied"
+    assert results["14"]["message"] == "Invalid job id specified"
+    # 13 is still running, 16 was not cancelled
+    assert sorted(slurmel_files.read_allocations()) == ["13", "16"]
+    local = json.loads((await jp_fetch("slurm-provisioner", "local")).body)
+    assert sorted(local["allocations"]) == ["13", "16"]
+
+
+async def test_cancel_rejected_job(jp_fetch, slurmel_files, fake_bin):
+    calls = fake_bin("scancel", fake_scancel)
+    slurmel_files.write_allocations({"13": allocation("13")})
+    writes = allocation_writes()
+    with pytest.raises(HTTPClientError) as e:
+        await post_scancel(jp_fetch, json.dumps({"jobid": "13"}))
+    assert e.value.code == 500
+    assert read_calls(calls) == [["13"]]
+    assert allocation_writes() == writes
+    assert list(slurmel_files.read_allocations()) == ["13"]
+
+
+@pytest.mark.parametrize("body", ["[1, 2]", "not json", '"13"', '{"jobids": "13"}'])
+async def test_invalid_body(jp_fetch, slurmel_files, fake_bin, body):
+    calls = fake_bin("scancel", "exit 0")
+    with pytest.raises(HTTPClientError) as e:
+        await post_scancel(jp_fetch, body)
+    assert e.value.code == 400
+    assert read_calls(calls) == []
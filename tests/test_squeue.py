@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+from datetime import datetime
+
+from conftest import allocation
+from conftest import read_calls
+from jupyter_slurm_provisioner_extension import _unload_jupyter_server_extension
+from jupyter_slurm_provisioner_extension.squeue import SqueuePoller
+from jupyter_slurm_provisioner_extension.squeue import expand_hostlist
+from jupyter_slurm_provisioner_extension.squeue import parse_squeue
+from jupyter_slurm_provisioner_extension.store import StateStore
+
+logger = logging.getLogger("test")
+
+squeue_output = """\
+1|RUNNING|jwc[01-03,07],jwlogin1|2030-01-01T12:00:00
+2|PENDING||N/A
+broken line
+"""
+
+
+def store_for(files):
+    return StateStore(files.kernel_file, files.allocations_file, files.archive_file)
+
+
+def test_expand_hostlist():
+    assert expand_hostlist("node001") == ["node001"]
+    assert expand_hostlist("jwc[01-03,07],jwlogin1") == ["jwc01", "jwc02", "jwc03", "jwc07", "jwlogin1"]
+    assert expand_hostlist("a[8-10]b,c[1]") == ["a8b", "a9b", "a10b", "c1"]
+
+
+def test_parse_squeue():
+    jobs = parse_squeue(squeue_output)
+    assert jobs == {
+        "1": {
+            "state": "RUNNING",
+            "nodelist": ["jwc01", "jwc02", "jwc03", "jwc07", "jwlogin1"],
+            "endtime": datetime(2030, 1, 1, 12).timestamp()
+        },
+        "2": {"state": "PENDING", "nodelist": [], "endtime": None}
+    }
+
+
+def test_update_jobs_overlays_slurm_state(slurmel_files):
+    slurmel_files.write_allocations({"1": allocation("1", ["k1"], state="PENDING")})
+    store = store_for(slurmel_files)
+    store.update_jobs({"1": {"state": "RUNNING", "nodelist": ["jwc01"], "endtime": 1893495600.0}}, {"1"}, logger)
+
+    merged = store.get_allocations(logger)["1"]
+    assert merged["state"] == "RUNNING"
+    assert merged["nodelist"] == ["jwc01"]
+    assert merged["endtime"] == 1893495600.0
+    assert merged["kernel_ids"] == ["k1"]
+    # the overlay is not written to the file
+    assert slurmel_files.read_allocations()["1"]["state"] == "PENDING"
+
+
+def test_update_jobs_prunes_only_queried_jobs(slurmel_files):
+    slurmel_files.write_allocations({"1": allocation("1"), "2": allocation("2"), "3": allocation("3")})
+    store = store_for(slurmel_files)
+    # 3 was added while squeue was running, 2 finished
+    store.update_jobs({"1": {"state": "RUNNING", "nodelist": [], "endtime": None}}, {"1", "2"}, logger)
+    assert sorted(slurmel_files.read_allocations()) == ["1", "3"]
+    assert sorted(store.get_allocations(logger)) == ["1", "3"]
+
+
+async def test_poller_with_fake_squeue(slurmel_files, fake_bin):
+    output = slurmel_files.allocations_file + ".squeue"
+    with open(output, "w") as f:
+        f.write(squeue_output)
+    calls = fake_bin("squeue", f"cat {output}")
+    slurmel_files.write_allocations({"1": allocation("1"), "2": allocation("2"), "5": allocation("5")})
+    store = store_for(slurmel_files)
+
+    await SqueuePoller(store, 30, 300).poll(logger)
+    assert read_calls(calls) == [["--me", "--noheader", "--format=%i|%T|%N|%e"]]
+    allocations = store.get_allocations(logger)
+    assert sorted(allocations) == ["1", "2"]
+    assert allocations["1"]["nodelist"] == ["jwc01", "jwc02", "jwc03", "jwc07", "jwlogin1"]
+    assert allocations["2"]["state"] == "PENDING"
+
+
+async def test_unload_stops_background_tasks(jp_serverapp, jp_fetch, slurmel_files, fake_bin):
+    fake_bin("squeue", "exit 0")
+    slurmel_files.write_allocations({})
+    await jp_fetch("slurm-provisioner", "local")
+    tasks = [task._task for task in jp_serverapp.web_app.settings["slurmel_tasks"]]
+    assert len(tasks) == 2 and not any(task.done() for task in tasks)
+
+    _unload_jupyter_server_extension(jp_serverapp)
+    await asyncio.wait(tasks, timeout=5)
+    assert all(task.cancelled() for task in tasks)
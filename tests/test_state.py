@@ -0,0 +1,71 @@
+import gzip
+import json
+import logging
+
+from conftest import allocation
+from jupyter_slurm_provisioner_extension import store as store_module
+from jupyter_slurm_provisioner_extension.store import StateStore
+
+logger = logging.getLogger("test")
+
+
+async def get_local(jp_fetch, etag=None, params=None):
+    headers = {"Accept-Encoding": "gzip"}
+    if etag:
+        headers["If-None-Match"] = etag
+    return await jp_fetch("slurm-provisioner", "local", headers=headers, params=params, decompress_response=False,
+                          raise_error=False)
+
+
+async def test_small_bodies_are_not_compressed(jp_fetch, slurmel_files):
+    slurmel_files.write_allocations({})
+    response = await get_local(jp_fetch)
+    assert response.code == 200
+    assert "Content-Encoding" not in response.headers
+    etag = response.headers["Etag"]
+    assert not etag.endswith('-gzip"')
+    assert json.loads(response.body)["allocations"] == {}
+    assert (await get_local(jp_fetch, etag)).code == 304
+
+
+async def test_large_bodies_are_compressed(jp_fetch, slurmel_files):
+    slurmel_files.write_allocations({str(jobid): allocation(str(jobid)) for jobid in range(100)})
+    response = await get_local(jp_fetch)
+    assert response.headers["Content-Encoding"] == "gzip"
+    etag = response.headers["Etag"]
+    assert etag.endswith('-gzip"')
+    assert len(json.loads(gzip.decompress(response.body))["allocations"]) == 100
+    assert (await get_local(jp_fetch, etag)).code == 304
+    # the same version without compression is still current
+    assert (await get_local(jp_fetch, etag.replace("-gzip", ""))).code == 304
+
+
+async def test_changes_since(jp_fetch, slurmel_files):
+    allocations = {jobid: allocation(jobid) for jobid in ["1", "2", "3"]}
+    slurmel_files.write_allocations({"1": allocations["1"], "2": allocations["2"]})
+    version = json.loads((await get_local(jp_fetch)).body)["version"]
+    slurmel_files.write_allocations({"1": allocations["1"], "3": allocations["3"]})
+    changes = json.loads((await get_local(jp_fetch, params={"since": version})).body)
+    assert changes["since"] == version
+    assert list(changes["allocations"]) == ["3"]
+    assert changes["removed"] == ["2"]
+    assert "current_config" not in changes
+
+
+def test_removed_allocations_are_limited(slurmel_files, monkeypatch):
+    monkeypatch.setattr(store_module, "removed_limit", 2)
+    store = StateStore(slurmel_files.kernel_file, slurmel_files.allocations_file, slurmel_files.archive_file)
+    allocations = {str(jobid): allocation(str(jobid)) for jobid in range(4)}
+    slurmel_files.write_allocations(allocations)
+    first = store.snapshot(logger)["version"]
+    versions = []
+    for jobid in ["0", "1", "2"]:
+        del allocations[jobid]
+        slurmel_files.write_allocations(allocations)
+        versions.append(store.snapshot(logger)["version"])
+
+    assert len(store._removed) == 2
+    # removals of 0 were forgotten: the full snapshot instead of wrong changes
+    assert "since" not in store.changes_since(first, logger)
+    changes = store.changes_since(versions[0], logger)
+    assert sorted(changes["removed"]) == ["1", "2"]
@@ -0,0 +1,97 @@
+import json
+import logging
+import os
+
+import pytest
+
+from conftest import allocation
+from jupyter_slurm_provisioner_extension import metrics
+from jupyter_slurm_provisioner_extension.store import JSONFile
+
+logger = logging.getLogger("test")
+
+
+@pytest.fixture
+def json_file(tmp_path):
+    return JSONFile(str(tmp_path / "state.json"), "test state", indent=2)
+
+
+def write(path, data, mtime_ns=None):
+    with open(path, "w") as f:
+        json.dump(data, f)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def writes(json_file):
+    return metrics.json_writes.values.get((json_file.name,), 0)
+
+
+def test_same_second_rewrite_is_noticed(json_file):
+    second = 1_700_000_000 * 10**9
+    write(json_file.path, {"jobid": "1"}, second)
+    assert json_file.read(logger) == {"jobid": "1"}
+    # same size and the same second, only the nanoseconds differ
+    write(json_file.path, {"jobid": "2"}, second + 1000)
+    assert json_file.read(logger) == {"jobid": "2"}
+
+
+def test_replaced_file_is_noticed(json_file):
+    mtime_ns = 1_700_000_000 * 10**9
+    write(json_file.path, {"jobid": "1"}, mtime_ns)
+    assert json_file.read(logger) == {"jobid": "1"}
+    # same size and mtime, only the inode differs
+    other = json_file.path + ".new"
+    write(other, {"jobid": "2"}, mtime_ns)
+    os.replace(other, json_file.path)
+    assert json_file.read(logger) == {"jobid": "2"}
+
+
+def test_unchanged_content_is_not_written(json_file):
+    assert json_file.write({"jobid": "1"}, logger)
+    count = writes(json_file)
+    file_id = json_file.identity()
+    assert not json_file.write({"jobid": "1"}, logger)
+    assert writes(json_file) == count
+    assert json_file.identity() == file_id
+
+
+def test_write_leaves_no_temporary_files(json_file, tmp_path):
+    write(json_file.path, {"jobid": "1"})
+    os.chmod(json_file.path, 0o600)
+    assert json_file.write({"jobid": "2"}, logger)
+    with pytest.raises(TypeError):
+        json_file.write({"jobid": object()}, logger)
+    assert os.listdir(tmp_path) == ["state.json"]
+    # replaced atomically, keeping the permissions
+    assert os.stat(json_file.path).st_mode & 0o777 == 0o600
+    with open(json_file.path) as f:
+        assert json.load(f) == {"jobid": "2"}
+
+
+def test_unparseable_file_keeps_last_snapshot(json_file):
+    write(json_file.path, {"jobid": "1"})
+    assert json_file.read(logger) == {"jobid": "1"}
+    with open(json_file.path, "w") as f:
+        f.write('{"jobid": ')
+    assert json_file.read(logger) == {"jobid": "1"}
+    write(json_file.path, {"jobid": "2"})
+    assert json_file.read(logger) == {"jobid": "2"}
+
+
+async def test_configure_goes_through_the_store(jp_fetch, slurmel_files):
+    slurmel_files.write_allocations({"1": allocation("1")})
+    local = json.loads((await jp_fetch("slurm-provisioner", "local")).body)
+    config = dict(allocation("1")["config"], node="node001")
+    kernel_writes = metrics.json_writes.values.get(("kernel.json",), 0)
+    response = await jp_fetch("slurm-provisioner", "configure", method="POST", body=json.dumps(config))
+    assert response.code == 200
+    assert metrics.json_writes.values.get(("kernel.json",), 0) == kernel_writes + 1
+    with open(slurmel_files.kernel_file) as f:
+        kernel_json = json.load(f)
+    assert kernel_json["metadata"]["kernel_provisioner"]["config"] == config
+    assert kernel_json["metadata"]["kernel_provisioner"]["provisioner_name"] == "slurm-provisioner"
+    # the store noticed its own write, the version changed
+    changed = json.loads((await jp_fetch("slurm-provisioner", "local")).body)
+    assert changed["current_config"] == config
+    assert changed["version"] != local["version"]
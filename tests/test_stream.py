@@ -0,0 +1,94 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from conftest import allocation
+from conftest import find_handler_kwargs
+from jupyter_slurm_provisioner_extension import handlers
+from jupyter_slurm_provisioner_extension.handlers import StateStream
+
+
+@pytest.fixture(autouse=True)
+def watch_interval(monkeypatch):
+    # read by setup_handlers, so it must be set before jp_serverapp
+    monkeypatch.setenv("SLURMEL_WATCH_INTERVAL", "0.05")
+    # squeue poller and compactor would stat the files as well
+    monkeypatch.setattr(handlers, "start_background_tasks", lambda tasks, logger: None)
+
+
+async def connect(jp_ws_fetch, clients):
+    sockets = [await jp_ws_fetch("slurm-provisioner", "stream") for _ in range(clients)]
+    for ws in sockets:
+        assert "allocations" in json.loads(await ws.read_message())
+    return sockets
+
+
+async def stats_per_check(watcher, watched, monkeypatch):
+    """Returns the numbers of os.stat calls on the watched files of the StateWatcher.check calls."""
+    stats = []
+    per_check = []
+    stat = os.stat
+    check = watcher.check
+
+    def counting_stat(path, *args, **kwargs):
+        if os.fspath(path) in watched:
+            stats.append(path)
+        return stat(path, *args, **kwargs)
+
+    async def counting_check(logger):
+        before = len(stats)
+        await check(logger)
+        per_check.append(len(stats) - before)
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "stat", counting_stat)
+        m.setattr(watcher, "check", counting_check)
+        await asyncio.sleep(0.5)
+    assert per_check
+    return set(per_check)
+
+
+async def test_one_watcher_for_all_clients(jp_serverapp, jp_ws_fetch, slurmel_files, monkeypatch):
+    slurmel_files.write_allocations({"1": allocation("1")})
+    watcher = find_handler_kwargs(jp_serverapp.web_app, StateStream)["watcher"]
+    watched = {slurmel_files.kernel_file, slurmel_files.allocations_file}
+
+    sockets = await connect(jp_ws_fetch, 1)
+    callback = watcher._callback
+    single = await stats_per_check(watcher, watched, monkeypatch)
+
+    sockets += await connect(jp_ws_fetch, 9)
+    assert len(watcher.subscribers) == 10
+    assert watcher._callback is callback and callback.is_running()
+    assert await stats_per_check(watcher, watched, monkeypatch) == single
+
+    for ws in sockets:
+        ws.close()
+    for _ in range(100):
+        if watcher._callback is None:
+            break
+        await asyncio.sleep(0.05)
+    # polling stops with the last client
+    assert watcher._callback is None and not callback.is_running()
+
+
+async def test_changes_are_pushed(jp_serverapp, jp_ws_fetch, slurmel_files):
+    allocations = {jobid: allocation(jobid) for jobid in ["1", "2", "3"]}
+    slurmel_files.write_allocations({"1": allocations["1"], "2": allocations["2"]})
+    sockets = [await jp_ws_fetch("slurm-provisioner", "stream") for _ in range(3)]
+    for ws in sockets:
+        state = json.loads(await ws.read_message())
+        assert "since" not in state
+        assert sorted(state["allocations"]) == ["1", "2"]
+
+    slurmel_files.write_allocations({"1": allocations["1"], "3": allocations["3"]})
+    for ws in sockets:
+        changes = json.loads(await asyncio.wait_for(ws.read_message(), 5))
+        # only the differences to the last message
+        assert changes["since"] == state["version"]
+        assert list(changes["allocations"]) == ["3"]
+        assert changes["removed"] == ["2"]
+        assert "current_config" not in changes
+        ws.close()